@@ -0,0 +1,168 @@
+import argparse
+import os
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from db import (
+    record_daily_stats,
+    replace_daily_stats,
+    get_daily_stats,
+    fetch_messages_after,
+)
+
+try:
+    from config import MAINTENANCE_BATCH_SIZE
+except ImportError:
+    MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "500"))
+
+TZ = ZoneInfo("Europe/Paris")
+
+# Compteurs reconstructibles depuis `messages` (les erreurs LLM/Google ne le sont pas)
+BACKFILL_METRICS = [
+    "conversations", "messages", "faq", "booking_attempt",
+    "confirmation", "confirmation_pending", "cancellation", "other",
+]
+
+
+def today() -> str:
+    return datetime.now(TZ).date().isoformat()
+
+
+# =========================================================
+# MISE À JOUR INCRÉMENTALE (à chaque tour)
+# =========================================================
+
+def record_turn(client_id: str, user_id: str, reply, turn: dict):
+    """
+    Incrémente les rollups du jour à partir du BotReply et des erreurs du tour.
+    booking_attempt : compté une fois par session, au tour où le draft devient complet.
+    """
+    availability = turn.get("availability")
+    llm_source = turn.get("llm_source")
+    increments = {
+        "messages": 1,
+        "booking_attempt": 1 if turn.get("draft_completed") else 0,
+        f"status_{reply.status}": 1,
+        "llm_errors": 1 if llm_source == "llm_error" else 0,
+        "llm_degraded": 1 if llm_source == "circuit_open" else 0,
+        "llm_skipped": 1 if llm_source == "local" else 0,
+        "google_errors": availability.google_errors if availability else 0,
+    }
+    if reply.branch != "booking_attempt":
+        increments[reply.branch] = 1
+    try:
+        record_daily_stats(client_id, today(), user_id, increments)
+    except Exception as e:
+        print("❌ Erreur stats :", repr(e))
+
+
+# =========================================================
+# LECTURE (dashboard admin)
+# =========================================================
+
+def dashboard(client_id: str, days: int = 30) -> dict:
+    """Compteurs par jour sur les `days` derniers jours, lus uniquement dans les rollups."""
+    since = (datetime.now(TZ).date() - timedelta(days=days - 1)).isoformat()
+    by_day = defaultdict(dict)
+    totals = Counter()
+    for row in get_daily_stats(client_id, since):
+        by_day[row["day"]][row["metric"]] = row["count"]
+        totals[row["metric"]] += row["count"]
+
+    conversations = totals.get("conversations", 0)
+    return {
+        "client_id": client_id,
+        "since": since,
+        "days": [{"day": day, **metrics} for day, metrics in sorted(by_day.items())],
+        "totals": dict(totals),
+        "conversion_rate": round(totals.get("confirmation", 0) / conversations, 3) if conversations else None,
+    }
+
+
+# =========================================================
+# BACKFILL DEPUIS L'HISTORIQUE
+# =========================================================
+
+def classify_reply(content: str) -> str:
+    """Branche d'une réponse assistant historique (d'après les textes de bot_logic)."""
+    if content.startswith("✅ Confirmé"):
+        return "confirmation"
+    if content.startswith("📞 Demande enregistrée"):
+        return "confirmation_pending"
+    if content in ("🚫 Annulé.", "❌ Annulé."):
+        return "cancellation"
+    if content.startswith(("Il me manque", "RDV pour", "🚫 Ce créneau", "Ce créneau est déjà passé", "Le garage est fermé", "❌ J'ai eu un souci")):
+        return "booking_attempt"
+    if content == "Bonjour ! Comment puis-je vous aider ?":
+        return "other"
+    return "faq"
+
+
+def _local_day(created_at: str) -> str:
+    dt = datetime.fromisoformat(created_at)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)  # created_at est en UTC (utcnow)
+    return dt.astimezone(TZ).date().isoformat()
+
+
+def backfill(batch_size: int = MAINTENANCE_BATCH_SIZE) -> dict:
+    """
+    Reconstruit les rollups des jours passés en parcourant `messages` par lots.
+    Le jour courant n'est pas touché (ses compteurs sont tenus en direct).
+    """
+    started = time.perf_counter()
+    until = today()
+    counts = defaultdict(Counter)
+    visitors = set()
+    completed = set()  # visiteurs dont le draft est complet (jusqu'à confirmation/annulation)
+    last_id = 0
+    scanned = 0
+
+    while True:
+        rows = fetch_messages_after(last_id, limit=batch_size)
+        if not rows:
+            break
+        for r in rows:
+            day = _local_day(r["created_at"])
+            if day >= until:
+                continue
+            key = (r["client_id"], day)
+            if r["role"] == "user":
+                counts[key]["messages"] += 1
+                if (r["client_id"], day, r["user_id"]) not in visitors:
+                    visitors.add((r["client_id"], day, r["user_id"]))
+                    counts[key]["conversations"] += 1
+            elif r["role"] == "assistant":
+                branch = classify_reply(r["content"])
+                visitor = (r["client_id"], r["user_id"])
+                if branch != "booking_attempt":
+                    counts[key][branch] += 1
+                    if branch in ("confirmation", "confirmation_pending", "cancellation"):
+                        completed.discard(visitor)
+                # Toute réponse de prise de RDV autre que "Il me manque" suppose un draft complet
+                elif not r["content"].startswith("Il me manque") and visitor not in completed:
+                    completed.add(visitor)
+                    counts[key]["booking_attempt"] += 1
+        scanned += len(rows)
+        last_id = rows[-1]["id"]
+
+    for (client_id, day), day_counts in counts.items():
+        replace_daily_stats(client_id, day, dict(day_counts), BACKFILL_METRICS)
+
+    report = {
+        "scanned_messages": scanned,
+        "days_rebuilt": len(counts),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    print("📊 Backfill stats :", report)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rollups statistiques")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--batch-size", type=int, default=MAINTENANCE_BATCH_SIZE)
+    args = parser.parse_args()
+    backfill(args.batch_size)
@@ -0,0 +1,174 @@
+"""
+Benchmark du démarrage à froid.
+
+    python bench_startup.py                 # profil d'import + temps jusqu'à la 1re réponse
+    python bench_startup.py --runs 5 --budget-ms 3000
+    python bench_startup.py --server uvicorn  # un seul processus (dev), sans preload
+    python bench_startup.py --preload-heavy   # PRELOAD_HEAVY_MODULES=1 : mémoire vs démarrage
+
+1. Profil d'import (`python -X importtime -c "import main"`) : modules les plus coûteux.
+2. Time-to-first-response : lance le serveur comme en production (`gunicorn main:app
+   -c gunicorn.conf.py`, WEB_CONCURRENCY workers) sur une base SQLite jetable et mesure
+   le temps entre le lancement et la première réponse 200 de /healthz.
+3. Mémoire : PSS cumulée (Linux) du master et des workers une fois tous les workers
+   démarrés ; les pages partagées en copy-on-write ne comptent qu'une fois.
+Code de sortie 1 si la médiane dépasse --budget-ms (utilisable en CI).
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _env(workdir: str) -> dict:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT
+    env["DATABASE_URL"] = "sqlite:///app.db"
+    env["WARMUP_BLOCKING"] = "0"
+    env["MAINTENANCE_INTERVAL_HOURS"] = "0"
+    env["SLOT_TABLE_REFRESH_MINUTES"] = "0"
+    return env
+
+
+def import_profile(top: int = 15) -> list:
+    """Modules triés par temps d'import cumulé (ms)."""
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import main"],
+            cwd=workdir, env=_env(workdir), capture_output=True, text=True,
+        )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = [p.strip() for p in line[len("import time:"):].split("|")]
+        rows.append({"module": name, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    return sorted(rows, key=lambda r: r["cumulative_ms"], reverse=True)[:top]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _server_command(server: str, port: int) -> list:
+    if server == "gunicorn":
+        return [
+            sys.executable, "-m", "gunicorn", "main:app",
+            "-c", os.path.join(ROOT, "gunicorn.conf.py"), "--bind", f"127.0.0.1:{port}",
+        ]
+    return [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"]
+
+
+def _children(pid: int) -> list:
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # ppid : 2e champ après le nom du processus (entre parenthèses)
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return children
+
+
+def _pss_mb(pids) -> float:
+    total_kb = 0
+    for pid in pids:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            total_kb += sum(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+    return round(total_kb / 1024, 1)
+
+
+def time_to_first_response(server: str = "gunicorn", workers: int = 4, preload_heavy: bool = False, timeout: float = 60.0) -> dict:
+    """ms entre le lancement du serveur et la première réponse de /healthz, puis mémoire (PSS) des processus."""
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(_env(workdir), WEB_CONCURRENCY=str(workers), PRELOAD_HEAVY_MODULES="1" if preload_heavy else "0")
+        started = time.perf_counter()
+        proc = subprocess.Popen(
+            _server_command(server, port),
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            first_response_ms = None
+            while time.perf_counter() - started < timeout:
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz", timeout=1) as r:
+                        if r.status == 200:
+                            first_response_ms = (time.perf_counter() - started) * 1000
+                            break
+                except OSError:
+                    time.sleep(0.02)
+            if first_response_ms is None:
+                raise TimeoutError("le serveur n'a pas répondu")
+
+            pss = None
+            if os.path.exists(f"/proc/{proc.pid}/smaps_rollup"):
+                expected = workers if server == "gunicorn" else 0
+                while len(_children(proc.pid)) < expected and time.perf_counter() - started < timeout:
+                    time.sleep(0.05)
+                time.sleep(1.0)  # fin du warmup des workers
+                pss = _pss_mb([proc.pid] + _children(proc.pid))
+            return {"first_response_ms": first_response_ms, "pss_mb": pss}
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--server", choices=["gunicorn", "uvicorn"], default="gunicorn")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "4")))
+    parser.add_argument("--preload-heavy", action="store_true", help="piles lourdes importées dans le master")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("STARTUP_BUDGET_MS", "0")))
+    parser.add_argument("--json", action="store_true", help="sortie JSON (pour suivre l'historique)")
+    args = parser.parse_args()
+
+    profile = import_profile(args.top)
+    runs = [time_to_first_response(args.server, args.workers, args.preload_heavy) for _ in range(args.runs)]
+    samples = [r["first_response_ms"] for r in runs]
+    median = statistics.median(samples)
+    pss = [r["pss_mb"] for r in runs if r["pss_mb"] is not None]
+    report = {
+        "server": args.server,
+        "workers": args.workers if args.server == "gunicorn" else 1,
+        "preload_heavy": args.preload_heavy,
+        "time_to_first_response_ms": {"median": round(median, 1), "samples": [round(s, 1) for s in samples]},
+        "pss_mb": statistics.median(pss) if pss else None,
+        "budget_ms": args.budget_ms or None,
+        "import_profile": profile,
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("📦 Imports les plus lents (cumulé) :")
+        for r in profile:
+            print(f"  {r['cumulative_ms']:8.1f} ms  {r['module']}")
+        print(f"⏱️ Time-to-first-response ({report['server']}, {report['workers']} worker(s)) : médiane {median:.0f} ms sur {args.runs} lancements {report['time_to_first_response_ms']['samples']}")
+        if report["pss_mb"] is not None:
+            print(f"🧠 Mémoire (PSS master + workers) : {report['pss_mb']} Mo")
+
+    if args.budget_ms and median > args.budget_ms:
+        print(f"❌ Budget de démarrage dépassé ({median:.0f} ms > {args.budget_ms:.0f} ms)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import re
 import os
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 from zoneinfo import ZoneInfo
 
 from db import (
@@ -11,9 +11,22 @@ from db import (
     get_session,
     upsert_session,
     clear_session,
+    create_appointment_with_outbox,
+    get_day_appointments,
+    get_google_credentials,
 )
 
-from google_services import is_slot_available_google, create_google_event
+from google_services import (
+    google_degraded,
+    get_busy_intervals,
+)
+from capacity import build_day_tree, has_capacity, service_duration, appointment_intervals
+from resilience import CircuitBreaker
+import slot_table
+import outbox
+import analytics
+import intent_model
+import profiler
 print("✅ BOT_LOGIC VERSION: 2025-12-30 A")
 
 
@@ -25,16 +38,28 @@ DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
 
 # --- GESTION IMPORTS OPENAI ---
 try:
-    from config import OPENAI_API_KEY, OPENAI_MODEL
+    from config import OPENAI_API_KEY, OPENAI_MODEL, OPENAI_TIMEOUT_SECONDS, BREAKER_OPEN_SECONDS, INTENT_CONFIDENCE
 except ImportError:
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+    OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "8"))
+    BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+    INTENT_CONFIDENCE = float(os.getenv("INTENT_CONFIDENCE", "0.85"))
+
+# Pool partagé pour paralléliser les étapes indépendantes d'un tour (DB, Google)
+# (les tâches héritent du contexte de l'appelant : profil en cours)
+TURN_EXECUTOR = profiler.ContextThreadPoolExecutor(max_workers=int(os.getenv("TURN_WORKERS", "16")), thread_name_prefix="turn")
+
+# Disjoncteur OpenAI : si le LLM est lent/en panne on passe en extraction regex seule
+llm_breaker = CircuitBreaker("openai", open_seconds=BREAKER_OPEN_SECONDS)
 
 
 @dataclass
 class BotReply:
     reply: str
     status: str
+    # Branche prise (statistiques) : faq | booking_attempt | confirmation | confirmation_pending | cancellation | other
+    branch: str = "other"
 
 
 # =========================================================
@@ -93,6 +118,16 @@ def fallback_intent(message: str) -> str:
     return "OTHER"
 
 
+def faq_fallback_answer(message: str, faq: dict) -> Optional[str]:
+    """Réponse FAQ sans LLM : première entrée dont la clé apparaît dans le message."""
+    m = message.lower()
+    aliases = {"horaires": ["horaire", "ouvert"], "telephone": ["tel", "téléphone", "appeler"], "email": ["mail"]}
+    for key, answer in (faq or {}).items():
+        if key in m or any(a in m for a in aliases.get(key, [])):
+            return answer
+    return None
+
+
 def extract_basic_info(message: str) -> Dict[str, Optional[str]]:
     data = {"name": None, "date": None, "time": None}
     msg = message.strip()
@@ -157,17 +192,40 @@ def extract_basic_info(message: str) -> Dict[str, Optional[str]]:
     return data
 
 
-def suggest_slots_google(client_id: str, date_str: str, start_time_str: str, count: int = 4, step_minutes: int = 60) -> List[str]:
+def detect_service(message: str, services: dict) -> Optional[str]:
+    """Prestation citée dans le message (clé de capacity["services"]), pour en déduire la durée."""
+    m = message.lower()
+    for service in services:
+        if service.lower() in m:
+            return service
+    return None
+
+
+def suggest_slots_google(
+    client_id: str, date_str: str, start_time_str: str, count: int = 4, step_minutes: int = 60,
+    busy=None, duration_mins: int = 60, resources: int = 1, tree=None,
+) -> List[str]:
     """
     Propose des créneaux disponibles après l'heure demandée.
+    Un seul appel Google pour la journée (ou aucun si `busy`/`tree` est déjà connu),
+    puis chaque candidat est vérifié en O(log n) sur l'arbre d'occupation.
     """
+    if tree is None:
+        if busy is None:
+            busy = get_busy_intervals(client_id, date_str)
+        if busy is None:
+            return []
+        tree = build_day_tree(busy, date_str)
+
     suggestions: List[str] = []
     base = datetime.fromisoformat(f"{date_str}T{start_time_str}").replace(tzinfo=TZ)
 
     for i in range(1, 12):  # jusqu'à +11h
         cand = base + timedelta(minutes=i * step_minutes)
+        if cand.date() != base.date():
+            break
         t = cand.strftime("%H:%M")
-        if is_slot_available_google(client_id, date_str, t):
+        if has_capacity(tree, t, duration_mins, resources):
             suggestions.append(t)
             if len(suggestions) >= count:
                 break
@@ -175,14 +233,175 @@ def suggest_slots_google(client_id: str, date_str: str, start_time_str: str, cou
     return suggestions
 
 
+class TurnAvailability:
+    """
+    Disponibilités pour un tour de conversation (capacité : plusieurs ponts possibles).
+    Occupation = événements Google (ceux du bot compris : le garage peut les déplacer ou
+    les supprimer) + RDV locaux pas encore envoyés à Google.
+    Côté Google, on lit d'abord la table précalculée (slot_table) ; sinon le jour détecté
+    par regex est préchargé en parallèle du LLM. live=True (confirmation) : lecture Google
+    directe, la table pouvant avoir jusqu'à 2 rafraîchissements de retard.
+    """
+
+    def __init__(self, client_id: str, cfg_future, speculative_date: Optional[str] = None):
+        self.client_id = client_id
+        self.google_errors = 0
+        self._cfg_future = cfg_future
+        self._busy: Dict[str, object] = {}
+        self._trees: Dict[str, object] = {}
+        if speculative_date and valid_date(speculative_date) and slot_table.get_busy(client_id, speculative_date) is None:
+            self._busy[speculative_date] = self._fetch(speculative_date)
+
+    @property
+    def capacity(self) -> dict:
+        return self._cfg_future.result()["capacity"]
+
+    def _fetch(self, date_str: str):
+        # cfg_future a été soumis avant : il est déjà en cours quand cette tâche l'attend
+        return TURN_EXECUTOR.submit(
+            lambda: get_busy_intervals(self.client_id, date_str, self.capacity["calendars"])
+        )
+
+    def _local_intervals(self, date_str: str, pending_only: bool = True):
+        # RDV envoyés à Google : comptés via leur événement (déplacé ou supprimé par le garage)
+        appointments = get_day_appointments(self.client_id, date_str, pending_only=pending_only)
+        return appointment_intervals(appointments, date_str, self.capacity["default_duration"])
+
+    def busy(self, date_str: str, live: bool = False):
+        busy = None if live else slot_table.get_busy(self.client_id, date_str)
+        if busy is None:
+            if date_str not in self._busy:
+                self._busy[date_str] = self._fetch(date_str)
+            busy = self._busy[date_str].result()
+        if busy is None:
+            # Client non connecté à Google : pas une erreur Google
+            if get_google_credentials(self.client_id):
+                self.google_errors += 1
+            return None
+        return busy + self._local_intervals(date_str)
+
+    def tree(self, date_str: str, live: bool = False):
+        if (date_str, live) not in self._trees:
+            busy = self.busy(date_str, live)
+            self._trees[(date_str, live)] = build_day_tree(busy, date_str) if busy is not None else None
+        return self._trees[(date_str, live)]
+
+    def is_available(self, date_str: str, time_str: str, duration_mins: int, live: bool = False) -> Optional[bool]:
+        """True/False, ou None si Google n'a pas pu répondre."""
+        tree = self.tree(date_str, live)
+        if tree is None:
+            return None
+        return has_capacity(tree, time_str, duration_mins, self.capacity["resources"])
+
+    def local_available(self, date_str: str, time_str: str, duration_mins: int) -> bool:
+        """Mode dégradé (Google indisponible) : capacité vérifiée sur les seuls RDV locaux."""
+        tree = build_day_tree(self._local_intervals(date_str, pending_only=False), date_str)
+        return has_capacity(tree, time_str, duration_mins, self.capacity["resources"])
+
+    def free_slots(self, date_str: str, duration_mins: int, after: str = "", count: int = 4, live: bool = False) -> Optional[List[str]]:
+        """
+        Créneaux libres précalculés (horaires d'ouverture, jours passés exclus), revérifiés
+        sur l'occupation actuelle du tour. None si la table n'a rien pour ce jour.
+        """
+        free = slot_table.get_free_slots(self.client_id, date_str)
+        if free is None:
+            return None
+        tree = self.tree(date_str, live)
+        if tree is None:
+            return None
+        resources = self.capacity["resources"]
+        return [t for t in free if t > after and has_capacity(tree, t, duration_mins, resources)][:count]
+
+    def suggest(self, date_str: str, time_str: str, duration_mins: int, count: int = 4, live: bool = False) -> List[str]:
+        free = self.free_slots(date_str, duration_mins, after=time_str, count=count, live=live)
+        if free is not None:
+            return free
+        tree = self.tree(date_str, live)
+        if tree is None:
+            return []
+        return suggest_slots_google(
+            self.client_id, date_str, time_str, count=count,
+            duration_mins=duration_mins, resources=self.capacity["resources"], tree=tree,
+        )
+
+
 # =========================================================
 # IA / LLM
 # =========================================================
 
-def llm_intent_and_extract(message: str, faq: dict, history: list) -> dict:
-    from openai import OpenAI
+def degraded_intent_and_extract(message: str, faq: dict, source: str = "circuit_open") -> dict:
+    """Mode dégradé : mots-clés + FAQ locale, sans appel réseau."""
+    return {
+        "intent": fallback_intent(message),
+        "answer": faq_fallback_answer(message, faq),
+        "name": None,
+        "date": None,
+        "time": None,
+        "source": source,
+    }
+
+
+# Date/heure exprimées en langage naturel : l'extraction reste au LLM
+DATE_HINTS_RE = re.compile(r"\d|lundi|mardi|mercredi|jeudi|vendredi|samedi|dimanche|demain|semaine|prochain|matin|midi|soir", re.I)
+
+
+@profiler.traced("intent_model.predict")
+def local_prediction(message: str) -> Optional[tuple]:
+    """(intention, confiance) du classifieur local s'il est sûr de lui, sinon None. Sans accès DB."""
+    prediction = intent_model.predict(message)
+    if prediction is None or prediction[1] < INTENT_CONFIDENCE:
+        return None
+    return prediction
+
+
+def local_intent_and_extract(prediction: tuple, message: str, faq: dict, regex_data: dict, stage: str, draft: dict) -> Optional[dict]:
+    """
+    Intention donnée par le classifieur local (cf. local_prediction) quand regex + FAQ locale
+    suffisent pour ce tour. None -> on appelle le LLM.
+    Prise de RDV : la regex doit fournir chaque info (nom, date, heure) encore absente du draft,
+    sinon un nom ou une date en texte libre serait perdu.
+    """
+    intent, confidence = prediction
+    answer = faq_fallback_answer(message, faq)
+    if intent == "FAQ" and not answer:
+        return None
+    if intent not in ("FAQ", "CANCEL") and (intent == "BOOK_APPOINTMENT" or stage in ["collecting", "confirming"]):
+        if any(not draft.get(field) and not regex_data.get(field) for field in ("name", "date", "time")):
+            return None
+        if DATE_HINTS_RE.search(message) and not (regex_data.get("date") or regex_data.get("time")):
+            return None
+
+    return {
+        "intent": intent,
+        "answer": answer,
+        "name": None,
+        "date": None,
+        "time": None,
+        "source": "local",
+        "confidence": round(confidence, 3),
+    }
+
+
+_openai_client = None
+
+
+def get_openai_client():
+    """Client OpenAI partagé : la connexion HTTP (TLS, keep-alive) est réutilisée entre les tours."""
+    global _openai_client
+    if _openai_client is None:
+        from openai import OpenAI
+        _openai_client = OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT_SECONDS, max_retries=0)
+    return _openai_client
+
+
+@profiler.traced("openai.chat")
+def llm_intent_and_extract(message: str, get_faq: Callable[[], dict], history: list) -> dict:
+    """Intention + extraction par le LLM. get_faq() (config du client) n'est attendu qu'en mode dégradé."""
+    if not llm_breaker.allow():
+        return degraded_intent_and_extract(message, get_faq())
+
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        client = get_openai_client()
         system = (
             f"Nous sommes le {datetime.now()}. Tu es un assistant de garage. "
             "Réponds UNIQUEMENT en JSON. Format: "
@@ -196,33 +415,126 @@ def llm_intent_and_extract(message: str, faq: dict, history: list) -> dict:
             response_format={"type": "json_object"},
             temperature=0
         )
+        llm_breaker.record_success()
         return json.loads(response.choices[0].message.content)
     except Exception as e:
         print(f"❌ Erreur OpenAI : {e}")
-        return {"intent": "OTHER", "answer": None, "name": None, "date": None, "time": None}
+        llm_breaker.record_failure()
+        return degraded_intent_and_extract(message, get_faq(), source="llm_error")
+
+
+def commit_booking(client_id: str, user_id: str, draft: dict, capacity: dict) -> bool:
+    """
+    RDV + entrée d'outbox en une transaction ; l'envoi à Google se fait en tâche de fond.
+    False si tous les ponts sont déjà réservés localement à cette heure.
+    """
+    duration = service_duration(capacity, draft.get("service"))
+    appointment_id = create_appointment_with_outbox(
+        client_id,
+        user_id,
+        draft["name"],
+        draft["date"],
+        draft["time"],
+        payload={
+            "user_id": user_id,
+            "date": draft["date"],
+            "time": draft["time"],
+            "summary": f"RDV - {draft['name']}",
+            "description": f"Rendez-vous pris via le bot pour {draft['name']}."
+            + (f" Prestation : {draft['service']}." if draft.get("service") else ""),
+            "duration_mins": duration,
+            "calendar_id": capacity["booking_calendar"],
+        },
+        duration_mins=duration,
+        resources=capacity["resources"],
+        default_duration=capacity["default_duration"],
+    )
+    if appointment_id is None:
+        return False
+    outbox.notify()
+    return True
+
+
+def capture_degraded_booking(client_id: str, user_id: str, draft: dict, cfg: dict) -> BotReply:
+    """
+    Google indisponible : on garde la demande en base (envoyée à Google par l'outbox au retour).
+    Aucun numéro n'est demandé au visiteur : on lui donne celui du garage (FAQ) pour s'assurer du créneau.
+    """
+    clear_session(client_id, user_id)
+    if not commit_booking(client_id, user_id, draft, cfg["capacity"]):
+        return BotReply("🚫 Ce créneau est pris. Propose une autre heure ou une autre date.", "needs_info", "booking_attempt")
+    phone = cfg.get("faq", {}).get("telephone")
+    return BotReply(
+        f"📞 Demande enregistrée pour {draft['name']} le {draft['date']} à {draft['time']}. "
+        "Notre agenda en ligne est momentanément indisponible : le créneau est retenu sous réserve "
+        "de disponibilité dans l'agenda du garage."
+        + (f" Pour en être sûr, appelez le garage au {phone}." if phone else ""),
+        "pending",
+        "confirmation_pending",
+    )
 
 
 # =========================================================
 # LOGIQUE PRINCIPALE
 # =========================================================
 
+@profiler.traced("handle_message")
 def handle_message(client_id: str, user_id: str, message: str, history: List[Dict[str, str]]) -> BotReply:
+    turn: Dict[str, object] = {}
+    reply = _handle_turn(client_id, user_id, message, history, turn)
+    # Statistiques (rollups) mises à jour hors du chemin critique
+    TURN_EXECUTOR.submit(analytics.record_turn, client_id, user_id, reply, turn)
+    return reply
+
+
+def _handle_turn(client_id: str, user_id: str, message: str, history: List[Dict[str, str]], turn: Dict[str, object]) -> BotReply:
     msg = (message or "").strip().lower()
-    cfg = get_client_config(client_id)
-    session = get_session(client_id, user_id)
+
+    # Étapes indépendantes lancées en parallèle sur le pool :
+    #   config + session (DB), LLM (n'attend la config qu'en mode dégradé),
+    #   jours occupés Google pour la date vue par regex
+    regex_data = extract_basic_info(message)
+    cfg_future = TURN_EXECUTOR.submit(get_client_config, client_id)
+    session_future = TURN_EXECUTOR.submit(get_session, client_id, user_id)
+
+    def start_llm():
+        return TURN_EXECUTOR.submit(
+            llm_intent_and_extract, message, lambda: cfg_future.result().get("faq", {}), history
+        )
+
+    # Classifieur local (sans DB) d'abord : le LLM ne part tout de suite que s'il n'est pas sûr de lui
+    prediction = local_prediction(message)
+    llm_future = None if prediction else start_llm()
+    availability = TurnAvailability(client_id, cfg_future, regex_data.get("date"))
+
+    turn["availability"] = availability
+
+    cfg = cfg_future.result()
+    session = session_future.result()
     stage = session["stage"]
     draft = json.loads(session["draft_json"] or "{}")
 
-    result = llm_intent_and_extract(message, cfg.get("faq", {}), history)
-    regex_data = extract_basic_info(message)
+    # Classifieur local sûr de lui, mais FAQ absente ou infos de RDV hors regex : LLM quand même
+    result = local_intent_and_extract(prediction, message, cfg.get("faq", {}), regex_data, stage, draft) if prediction else None
+    if result is None:
+        result = (llm_future or start_llm()).result()
+    turn["llm_source"] = result.get("source", "llm")
 
     # Mise à jour du draft
+    was_complete = all(draft.get(field) for field in ("name", "date", "time"))
     if result.get("name") or regex_data.get("name"):
         draft["name"] = result.get("name") or regex_data.get("name")
     if result.get("date") or regex_data.get("date"):
         draft["date"] = result.get("date") or regex_data.get("date")
     if result.get("time") or regex_data.get("time"):
         draft["time"] = result.get("time") or regex_data.get("time")
+    capacity = cfg["capacity"]
+    service = detect_service(message, capacity["services"])
+    if service:
+        draft["service"] = service
+    duration = service_duration(capacity, draft.get("service"))
+    # Stats : une tentative de RDV par session, quand le draft devient complet
+    turn["draft_completed"] = not was_complete and all(draft.get(field) for field in ("name", "date", "time"))
 
     # Sauvegarde session
     upsert_session(client_id, user_id, stage, json.dumps(draft))
@@ -232,27 +544,34 @@ def handle_message(client_id: str, user_id: str, message: str, history: List[Dic
     # -------------------------
     if result.get("intent") == "CANCEL" or fallback_intent(message) == "CANCEL":
         clear_session(client_id, user_id)
-        return BotReply("🚫 Annulé.", "ok")
+        return BotReply("🚫 Annulé.", "ok", "cancellation")
 
     # -------------------------
-    # CAS 2 : CONFIRMATION (création Google ici)
+    # CAS 2 : CONFIRMATION (RDV commité localement, Google via l'outbox)
     # -------------------------
     if stage == "confirming":
         if msg in ["oui", "ok", "d'accord", "je confirme", "yes"]:
             # vérifs basiques
             if not (draft.get("name") and draft.get("date") and draft.get("time")):
                 upsert_session(client_id, user_id, "collecting", json.dumps(draft))
-                return BotReply("Il me manque : ton nom, la date, l'heure.", "needs_info")
+                return BotReply("Il me manque : ton nom, la date, l'heure.", "needs_info", "booking_attempt")
 
             if is_past(draft["date"], draft["time"]):
-                return BotReply("Ce créneau est déjà passé. Choisis une autre date.", "needs_info")
+                return BotReply("Ce créneau est déjà passé. Choisis une autre date.", "needs_info", "booking_attempt")
 
             if not in_opening_hours(cfg["opening_hours"], draft["date"], draft["time"]):
-                return BotReply("Le garage est fermé à cette heure-là.", "needs_info")
-
-            # check Google
-            if not is_slot_available_google(client_id, draft["date"], draft["time"]):
-                sugg = suggest_slots_google(client_id, draft["date"], draft["time"], count=4)
+                return BotReply("Le garage est fermé à cette heure-là.", "needs_info", "booking_attempt")
+
+            # Google en panne : capture locale
+            if google_degraded():
+                return capture_degraded_booking(client_id, user_id, draft, cfg)
+
+            # check Google en direct (la table précalculée peut être en retard)
+            available = availability.is_available(draft["date"], draft["time"], duration, live=True)
+            if available is None:
+                return capture_degraded_booking(client_id, user_id, draft, cfg)
+            if not available:
+                sugg = availability.suggest(draft["date"], draft["time"], duration, count=4, live=True)
                 if sugg:
                     clear_session(client_id, user_id)
                     return BotReply(
@@ -260,43 +579,31 @@ def handle_message(client_id: str, user_id: str, message: str, history: List[Dic
                         "Créneaux disponibles : " + ", ".join(sugg) + "\n"
                         "Réponds juste avec l'heure (ex: 16:00).",
                         "needs_info",
+                        "booking_attempt",
                     )
                 clear_session(client_id, user_id)
-                return BotReply("🚫 Ce créneau est pris. Propose une autre heure ou une autre date.", "needs_info")
-
-            # création Google
-            link = create_google_event(
-                client_id=client_id,
-                date_str=draft["date"],
-                time_str=draft["time"],
-                summary=f"RDV - {draft['name']}",
-                description=f"Rendez-vous pris via le bot pour {draft['name']}.",
-                duration_mins=60,
-            )
+                return BotReply("🚫 Ce créneau est pris. Propose une autre heure ou une autre date.", "needs_info", "booking_attempt")
 
+            # RDV commité + outbox ; la table de créneaux est recalculée après l'envoi
             clear_session(client_id, user_id)
-
-            if not link:
-                return BotReply(
-                    "❌ J'ai eu un souci pour ajouter le rendez-vous dans Google Agenda. "
-                    "Réessaie dans 1 minute, ou contacte l'admin.",
-                    "needs_info",
-                )
+            if not commit_booking(client_id, user_id, draft, capacity):
+                return BotReply("🚫 Ce créneau est pris. Propose une autre heure ou une autre date.", "needs_info", "booking_attempt")
 
             return BotReply(
                 f"✅ Confirmé pour {draft['name']} le {draft['date']} à {draft['time']}.",
                 "ok",
+                "confirmation",
             )
 
         # pas confirmé => annule
         clear_session(client_id, user_id)
-        return BotReply("❌ Annulé.", "ok")
+        return BotReply("❌ Annulé.", "ok", "cancellation")
 
     # -------------------------
     # CAS 3 : FAQ
     # -------------------------
     if result.get("intent") == "FAQ" or fallback_intent(message) == "FAQ":
-        return BotReply(result.get("answer") or "Je n'ai pas l'info.", "ok")
+        return BotReply(result.get("answer") or "Je n'ai pas l'info.", "ok", "faq")
 
     # -------------------------
     # CAS 4 : PRISE DE RDV (collecte des infos + demande de confirmation)
@@ -312,30 +619,44 @@ def handle_message(client_id: str, user_id: str, message: str, history: List[Dic
 
         if missing:
             upsert_session(client_id, user_id, "collecting", json.dumps(draft))
-            return BotReply(f"Il me manque : {', '.join(missing)}.", "needs_info")
+            reply = f"Il me manque : {', '.join(missing)}."
+            # Date connue : on propose les créneaux libres précalculés (sans appel Google)
+            if draft.get("date") and not draft.get("time") and valid_date(draft["date"]):
+                free = availability.free_slots(draft["date"], duration)
+                if free:
+                    reply += f"\nCréneaux libres le {draft['date']} : " + ", ".join(free)
+            return BotReply(reply, "needs_info", "booking_attempt")
 
         if is_past(draft["date"], draft["time"]):
-            return BotReply("Ce créneau est déjà passé. Choisis une autre date.", "needs_info")
+            return BotReply("Ce créneau est déjà passé. Choisis une autre date.", "needs_info", "booking_attempt")
         if not in_opening_hours(cfg["opening_hours"], draft["date"], draft["time"]):
-            return BotReply("Le garage est fermé à cette heure-là.", "needs_info")
+            return BotReply("Le garage est fermé à cette heure-là.", "needs_info", "booking_attempt")
+
+        # Google en panne (circuit pas fermé, ou appel refusé/en erreur) : on ne vérifie que les RDV locaux
+        available = None if google_degraded() else availability.is_available(draft["date"], draft["time"], duration)
+        if available is None:
+            if not availability.local_available(draft["date"], draft["time"], duration):
+                return BotReply("🚫 Ce créneau est pris. Propose une autre heure ou une autre date.", "needs_info", "booking_attempt")
 
         # si déjà pris, proposer alternatives
-        if not is_slot_available_google(client_id, draft["date"], draft["time"]):
-            sugg = suggest_slots_google(client_id, draft["date"], draft["time"], count=4)
+        elif not available:
+            sugg = availability.suggest(draft["date"], draft["time"], duration, count=4)
             if sugg:
                 return BotReply(
                     "🚫 Ce créneau est occupé sur Google Agenda.\n"
                     "Créneaux disponibles : " + ", ".join(sugg) + "\n"
                     "Réponds juste avec l'heure (ex: 16:00).",
                     "needs_info",
+                    "booking_attempt",
                 )
-            return BotReply("🚫 Ce créneau est pris. Propose une autre heure ou une autre date.", "needs_info")
+            return BotReply("🚫 Ce créneau est pris. Propose une autre heure ou une autre date.", "needs_info", "booking_attempt")
 
         # demande confirmation
         upsert_session(client_id, user_id, "confirming", json.dumps(draft))
         return BotReply(
             f"RDV pour {draft['name']} le {draft['date']} à {draft['time']}. C'est bon ? (OUI)",
             "needs_info",
+            "booking_attempt",
         )
 
     return BotReply("Bonjour ! Comment puis-je vous aider ?", "ok")
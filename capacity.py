@@ -0,0 +1,145 @@
+import datetime
+import os
+from typing import Dict, List, Optional
+from zoneinfo import ZoneInfo
+
+from pydantic import BaseModel, Field, model_validator
+
+try:
+    from config import APPOINTMENT_DURATION_MINUTES
+except ImportError:
+    APPOINTMENT_DURATION_MINUTES = int(os.getenv("APPOINTMENT_DURATION_MINUTES", "60"))
+
+TZ = ZoneInfo("Europe/Paris")
+MINUTES_PER_DAY = 24 * 60
+# Événement couvrant toute la journée (fermeture, congés) : occupe toutes les ressources
+CLOSED_DAY_WEIGHT = 1 << 20
+
+DEFAULT_CAPACITY = {
+    "resources": 1,           # ponts / mécaniciens en parallèle
+    "default_duration": APPOINTMENT_DURATION_MINUTES,  # minutes
+    "services": {},           # {"vidange": 30, "révision": 90, ...}
+    "calendars": ["primary"], # agendas Google lus (un événement = une ressource occupée)
+    "booking_calendar": "primary",
+}
+
+
+class CapacityConfig(BaseModel):
+    """Config de capacité envoyée par l'admin (PUT /admin/capacity) : 422 si invalide."""
+
+    resources: int = Field(DEFAULT_CAPACITY["resources"], ge=1, le=100)
+    default_duration: int = Field(DEFAULT_CAPACITY["default_duration"], ge=5, le=MINUTES_PER_DAY)
+    services: Dict[str, int] = Field(default_factory=dict)
+    calendars: List[str] = Field(default_factory=lambda: list(DEFAULT_CAPACITY["calendars"]), min_length=1)
+    # Par défaut : le premier agenda lu
+    booking_calendar: Optional[str] = None
+
+    @model_validator(mode="after")
+    def _check(self):
+        for service, duration in self.services.items():
+            if not service.strip() or not 5 <= duration <= MINUTES_PER_DAY:
+                raise ValueError(f"prestation invalide : {service!r} ({duration} min)")
+        if self.booking_calendar is None:
+            self.booking_calendar = self.calendars[0]
+        if self.booking_calendar not in self.calendars:
+            raise ValueError("booking_calendar doit faire partie de calendars")
+        return self
+
+
+def normalize_capacity(raw: dict = None) -> dict:
+    """Config de capacité complétée par les valeurs par défaut."""
+    cap = dict(DEFAULT_CAPACITY)
+    cap.update({k: v for k, v in (raw or {}).items() if v is not None})
+    cap["resources"] = max(1, int(cap["resources"]))
+    cap["calendars"] = list(cap["calendars"]) or ["primary"]
+    return cap
+
+
+def service_duration(capacity: dict, service: str = None) -> int:
+    return int(capacity["services"].get(service, capacity["default_duration"])) if service else int(capacity["default_duration"])
+
+
+# =========================================================
+# ARBRE DE SEGMENTS : réservations simultanées par minute
+# =========================================================
+
+class OccupancyTree:
+    """
+    Occupation d'une journée à la minute près.
+    add(start, end)         : +1 sur [start, end)                 O(log n)
+    max_concurrent(s, e)    : max de réservations simultanées     O(log n)
+    """
+
+    def __init__(self, size: int = MINUTES_PER_DAY):
+        self.size = size
+        self._max = [0] * (4 * size)
+        self._lazy = [0] * (4 * size)
+
+    def _add(self, node, lo, hi, start, end, value):
+        if end <= lo or hi <= start:
+            return
+        if start <= lo and hi <= end:
+            self._max[node] += value
+            self._lazy[node] += value
+            return
+        mid = (lo + hi) // 2
+        self._add(2 * node, lo, mid, start, end, value)
+        self._add(2 * node + 1, mid, hi, start, end, value)
+        self._max[node] = self._lazy[node] + max(self._max[2 * node], self._max[2 * node + 1])
+
+    def _query(self, node, lo, hi, start, end):
+        if end <= lo or hi <= start:
+            return 0
+        if start <= lo and hi <= end:
+            return self._max[node]
+        mid = (lo + hi) // 2
+        return self._lazy[node] + max(
+            self._query(2 * node, lo, mid, start, end),
+            self._query(2 * node + 1, mid, hi, start, end),
+        )
+
+    def add(self, start: int, end: int, value: int = 1):
+        start, end = max(0, start), min(self.size, end)
+        if start < end:
+            self._add(1, 0, self.size, start, end, value)
+
+    def max_concurrent(self, start: int, end: int) -> int:
+        start, end = max(0, start), min(self.size, end)
+        if start >= end:
+            return 0
+        return self._query(1, 0, self.size, start, end)
+
+
+def _minute_of_day(dt: datetime.datetime, day_start: datetime.datetime) -> int:
+    return int((dt - day_start).total_seconds() // 60)
+
+
+def appointment_intervals(appointments, date_str: str, default_duration: int):
+    """RDV locaux [(heure, durée ou None)] -> intervalles [(début, fin)] du jour."""
+    intervals = []
+    for t, duration in appointments:
+        start = datetime.datetime.fromisoformat(f"{date_str}T{t}").replace(tzinfo=TZ)
+        intervals.append((start, start + datetime.timedelta(minutes=duration or default_duration)))
+    return intervals
+
+
+def build_day_tree(busy, date_str: str) -> OccupancyTree:
+    """
+    Arbre d'occupation du jour à partir des intervalles occupés (tous agendas confondus).
+    Un intervalle qui couvre toute la journée ferme le jour, quel que soit le nombre de ponts.
+    """
+    day = datetime.date.fromisoformat(date_str)
+    day_start = datetime.datetime.combine(day, datetime.time(0, 0), TZ)
+    day_end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time(0, 0), TZ)
+    tree = OccupancyTree()
+    for ev_start, ev_end in busy:
+        weight = CLOSED_DAY_WEIGHT if ev_start <= day_start and ev_end >= day_end else 1
+        tree.add(_minute_of_day(ev_start, day_start), _minute_of_day(ev_end, day_start), weight)
+    return tree
+
+
+def has_capacity(tree: OccupancyTree, time_str: str, duration_mins: int, resources: int) -> bool:
+    """True s'il reste au moins une ressource libre sur tout [heure, heure + durée)."""
+    hh, mm = map(int, time_str.split(":"))
+    start = hh * 60 + mm
+    return tree.max_concurrent(start, start + duration_mins) < resources
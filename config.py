@@ -19,4 +19,54 @@ GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 GOOGLE_REDIRECT_URI = "https://bot-rdv.onrender.com/oauth2callback"
 
 # Sécurité Admin : Récupéré via Render (Aucun mot de passe écrit ici !)
-ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
\ No newline at end of file
+ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
+
+# Maintenance : rétention des messages et expiration des sessions
+MESSAGES_RETENTION_DAYS = int(os.getenv("MESSAGES_RETENTION_DAYS", "90"))
+SESSIONS_TTL_HOURS = int(os.getenv("SESSIONS_TTL_HOURS", "48"))
+# Dossier d'archives sur un disque persistant (disque Render monté) : sans lui, aucun message n'est supprimé
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "")
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "500"))
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", "24"))
+
+# Résilience : timeouts des appels externes + disjoncteurs
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "8"))
+GOOGLE_TIMEOUT_SECONDS = float(os.getenv("GOOGLE_TIMEOUT_SECONDS", "5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+
+# Table des créneaux libres précalculée (rafraîchie en tâche de fond)
+SLOT_TABLE_DAYS = int(os.getenv("SLOT_TABLE_DAYS", "14"))
+SLOT_TABLE_REFRESH_MINUTES = float(os.getenv("SLOT_TABLE_REFRESH_MINUTES", "10"))
+APPOINTMENT_DURATION_MINUTES = int(os.getenv("APPOINTMENT_DURATION_MINUTES", "60"))
+
+# Serveur de production (gunicorn + workers uvicorn)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "10"))
+# Connexions réservées aux verrous de tour (une par tour en cours), hors du pool ci-dessus
+DB_LOCK_POOL_MAX = int(os.getenv("DB_LOCK_POOL_MAX", "10"))
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+# 0 = la pile Google/OpenAI est chargée après l'ouverture du port (démarrage à froid plus rapide)
+WARMUP_BLOCKING = os.getenv("WARMUP_BLOCKING", "1") == "1"
+# Import des piles Google/OpenAI/NumPy dans le master gunicorn avant le fork : moins de mémoire
+# (copy-on-write) mais ~1 s de démarrage à froid en plus. Désactivé par défaut.
+PRELOAD_HEAVY_MODULES = os.getenv("PRELOAD_HEAVY_MODULES", "0") == "1"
+
+# Outbox : envoi différé des RDV vers Google Calendar
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+
+# Single-flight : durée de vie (très courte) d'un résultat Google partagé
+SINGLEFLIGHT_TTL_SECONDS = float(os.getenv("SINGLEFLIGHT_TTL_SECONDS", "2"))
+
+# Anti-double envoi : un message identique dans cette fenêtre reçoit la même réponse
+DUPLICATE_WINDOW_SECONDS = float(os.getenv("DUPLICATE_WINDOW_SECONDS", "5"))
+
+# Classifieur d'intention local : au-dessus du seuil de confiance, pas d'appel LLM
+INTENT_MODEL_PATH = os.getenv("INTENT_MODEL_PATH", "intent_model.npz")
+INTENT_CONFIDENCE = float(os.getenv("INTENT_CONFIDENCE", "0.85"))
+
+# Profilage à la demande : fraction des tours profilés au démarrage, profils gardés en mémoire
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "50"))
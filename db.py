@@ -1,15 +1,21 @@
 import os
 import json
 import sqlite3
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import profiler
 
 # --- DATABASE_URL ---
 try:
-    from config import DATABASE_URL
+    from config import DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT_SECONDS, DB_LOCK_POOL_MAX
 except ImportError:
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app.db")
+    DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+    DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+    DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "10"))
+    DB_LOCK_POOL_MAX = int(os.getenv("DB_LOCK_POOL_MAX", "10"))
 
 
 def _is_sqlite() -> bool:
@@ -21,13 +27,112 @@ def _ph() -> str:
     return "?" if _is_sqlite() else "%s"
 
 
+# --- Pool Postgres (un par processus : créé après le fork des workers) ---
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# getconn() lève une erreur quand le pool est vide : le sémaphore fait attendre à la place
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+# --- Pool dédié aux verrous de tour (session_turn_lock) ---
+# Un tour garde sa connexion de verrou pendant tout l'appel LLM : elle ne doit jamais
+# prendre la place des connexions dont le tour a besoin (pool principal).
+_lock_pool = None
+_lock_pool_pid = None
+_lock_slots = threading.BoundedSemaphore(DB_LOCK_POOL_MAX)
+
+
+class PoolExhaustedError(RuntimeError):
+    """Aucune connexion du pool libérée dans le délai DB_POOL_TIMEOUT_SECONDS."""
+
+
+class _PooledConn:
+    """Connexion empruntée au pool : close() la rend au pool au lieu de la fermer."""
+
+    def __init__(self, pool, conn, slots):
+        self._pool = pool
+        self._conn = conn
+        self._slots = slots
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is None:
+            return
+        broken = bool(self._conn.closed)
+        if not broken:
+            try:
+                self._conn.rollback()
+            except Exception:
+                broken = True
+        self._pool.putconn(self._conn, close=broken)
+        self._conn = None
+        self._slots.release()
+
+
+def _get_pool():
+    global _pool, _pool_pid, _pool_slots
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                # Import différé : inutile en local (SQLite)
+                from psycopg2.extras import RealDictCursor
+                from psycopg2.pool import ThreadedConnectionPool
+                _pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, cursor_factory=RealDictCursor)
+                _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def warm_pool() -> int:
+    """Ouvre DB_POOL_MIN connexions d'avance (warmup). Retourne le nombre de connexions prêtes."""
+    if _is_sqlite():
+        return 0
+    conns = [get_conn() for _ in range(DB_POOL_MIN)]
+    for c in conns:
+        c.close()
+    return len(conns)
+
+
+def _get_lock_pool():
+    global _lock_pool, _lock_pool_pid, _lock_slots
+    if _lock_pool is None or _lock_pool_pid != os.getpid():
+        with _pool_lock:
+            if _lock_pool is None or _lock_pool_pid != os.getpid():
+                from psycopg2.pool import ThreadedConnectionPool
+                _lock_pool = ThreadedConnectionPool(0, DB_LOCK_POOL_MAX, DATABASE_URL)
+                _lock_slots = threading.BoundedSemaphore(DB_LOCK_POOL_MAX)
+                _lock_pool_pid = os.getpid()
+    return _lock_pool
+
+
+def close_pool():
+    """Ferme toutes les connexions des pools (arrêt du worker)."""
+    global _pool, _lock_pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.closeall()
+    if _lock_pool is not None and _lock_pool_pid == os.getpid():
+        _lock_pool.closeall()
+    _pool = None
+    _lock_pool = None
+
+
 def get_conn():
-    """Connexion DB compatible SQLite (local) et Postgres (Render)."""
+    """Connexion DB compatible SQLite (local) et Postgres (Render, via pool)."""
     if _is_sqlite():
         conn = sqlite3.connect("app.db", check_same_thread=False)
         conn.row_factory = sqlite3.Row
         return conn
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    pool = _get_pool()
+    slots = _pool_slots
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT_SECONDS):
+        raise PoolExhaustedError(f"pool DB saturé ({DB_POOL_MAX} connexions) depuis {DB_POOL_TIMEOUT_SECONDS:.0f} s")
+    try:
+        return _PooledConn(pool, pool.getconn(), slots)
+    except Exception:
+        slots.release()
+        raise
 
 
 def _fetchone(cur):
@@ -82,7 +187,87 @@ def init_db():
         date TEXT NOT NULL,
         time TEXT NOT NULL,
         created_at TEXT NOT NULL,
-        UNIQUE(client_id, date, time)
+        bay INTEGER NOT NULL DEFAULT 0,
+        duration_mins INTEGER,
+        UNIQUE(client_id, date, time, bay)
+    )
+    """
+
+    create_slot_table = """
+    CREATE TABLE IF NOT EXISTS slot_table (
+        client_id TEXT NOT NULL,
+        date TEXT NOT NULL,
+        busy_json TEXT NOT NULL,
+        free_json TEXT NOT NULL,
+        refreshed_at TEXT NOT NULL,
+        PRIMARY KEY (client_id, date)
+    )
+    """
+
+    create_outbox = f"""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id {id_type},
+        client_id TEXT NOT NULL,
+        appointment_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        payload_json TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT NOT NULL,
+        last_error TEXT,
+        created_at TEXT NOT NULL,
+        processed_at TEXT
+    )
+    """
+
+    create_daily_stats = """
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        client_id TEXT NOT NULL,
+        day TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (client_id, day, metric)
+    )
+    """
+
+    create_daily_visitors = """
+    CREATE TABLE IF NOT EXISTS daily_visitors (
+        client_id TEXT NOT NULL,
+        day TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        PRIMARY KEY (client_id, day, user_id)
+    )
+    """
+
+    # Tâches singleton (maintenance, rafraîchissement des créneaux) : un seul worker à la fois
+    create_leases = """
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        expires_at TEXT NOT NULL
+    )
+    """
+
+    # Réglages partagés par les workers (ex. profilage) et profils capturés
+    create_app_settings = """
+    CREATE TABLE IF NOT EXISTS app_settings (
+        key TEXT PRIMARY KEY,
+        value_json TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+    """
+
+    create_profiles = f"""
+    CREATE TABLE IF NOT EXISTS profiles (
+        id {id_type},
+        client_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        worker TEXT NOT NULL,
+        reason TEXT NOT NULL,
+        started_at TEXT NOT NULL,
+        duration_ms REAL NOT NULL,
+        breakdown_json TEXT NOT NULL,
+        data_json TEXT NOT NULL
     )
     """
 
@@ -92,21 +277,94 @@ def init_db():
         cur.execute(create_messages)
         cur.execute(create_sessions)
         cur.execute(create_appointments)
+        cur.execute(create_slot_table)
+        cur.execute(create_outbox)
+        cur.execute(create_daily_stats)
+        cur.execute(create_daily_visitors)
+        cur.execute(create_leases)
+        cur.execute(create_app_settings)
+        cur.execute(create_profiles)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+        # Index pour la maintenance (purge par date)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions (updated_at)")
         conn.commit()
     finally:
         conn.close()
 
+    # Résultat de l'envoi Google (outbox)
+    _add_column_if_missing("appointments", "google_event_id")
+    _add_column_if_missing("appointments", "google_link")
+    # Capacité (plusieurs ponts / mécaniciens)
+    _add_column_if_missing("clients", "capacity_json")
+    _add_column_if_missing("appointments", "duration_mins", "INTEGER")
+    # Anti-double envoi partagé entre workers : dernier message traité + sa réponse
+    _add_column_if_missing("sessions", "last_message_hash")
+    _add_column_if_missing("sessions", "last_reply_json")
+    _add_column_if_missing("sessions", "last_message_at")
+    _migrate_appointments_bay()
 
-def ensure_default_client(client_id: str):
-    """Crée un client par défaut si absent."""
+
+def _migrate_appointments_bay():
+    """
+    Vieilles DB : UNIQUE(client_id, date, time) -> UNIQUE(client_id, date, time, bay),
+    pour accepter plusieurs RDV à la même heure (un par pont).
+    """
     conn = get_conn()
-    ph = _ph()
     try:
         cur = conn.cursor()
-        cur.execute(f"SELECT id FROM clients WHERE id = {ph}", (client_id,))
-        if cur.fetchone():
+        if _is_sqlite():
+            cur.execute("PRAGMA table_info(appointments)")
+            if "bay" in [r[1] for r in cur.fetchall()]:
+                return
+            # SQLite ne sait pas supprimer une contrainte : on reconstruit la table
+            cur.execute("ALTER TABLE appointments RENAME TO appointments_old")
+            cur.execute("""
+                CREATE TABLE appointments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    client_id TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    time TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    bay INTEGER NOT NULL DEFAULT 0,
+                    duration_mins INTEGER,
+                    google_event_id TEXT,
+                    google_link TEXT,
+                    UNIQUE(client_id, date, time, bay)
+                )
+            """)
+            cur.execute("""
+                INSERT INTO appointments (id, client_id, user_id, name, date, time, created_at, duration_mins, google_event_id, google_link)
+                SELECT id, client_id, user_id, name, date, time, created_at, duration_mins, google_event_id, google_link
+                FROM appointments_old
+            """)
+            cur.execute("DROP TABLE appointments_old")
+            conn.commit()
+            return
+
+        cur.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name='appointments' AND column_name='bay'
+            LIMIT 1
+        """)
+        if cur.fetchone() is not None:
             return
+        cur.execute("ALTER TABLE appointments ADD COLUMN bay INTEGER NOT NULL DEFAULT 0")
+        cur.execute("ALTER TABLE appointments DROP CONSTRAINT IF EXISTS appointments_client_id_date_time_key")
+        cur.execute("ALTER TABLE appointments ADD CONSTRAINT appointments_client_date_time_bay_key UNIQUE (client_id, date, time, bay)")
+        conn.commit()
+    finally:
+        conn.close()
 
+
+def ensure_default_client(client_id: str):
+    """Crée un client par défaut si absent (une seule requête, sûre en concurrence)."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
         default_hours = {
             "mon": {"start": "09:00", "end": "18:00"},
             "tue": {"start": "09:00", "end": "18:00"},
@@ -126,6 +384,7 @@ def ensure_default_client(client_id: str):
             f"""
             INSERT INTO clients (id, name, opening_hours_json, faq_json)
             VALUES ({ph}, {ph}, {ph}, {ph})
+            ON CONFLICT (id) DO NOTHING
             """,
             (client_id, f"Client {client_id}", json.dumps(default_hours), json.dumps(default_faq)),
         )
@@ -134,23 +393,44 @@ def ensure_default_client(client_id: str):
         conn.close()
 
 
-def get_client_config(client_id: str):
+def _fetch_client_row(client_id: str):
     conn = get_conn()
     ph = _ph()
     try:
         cur = conn.cursor()
         cur.execute(f"SELECT * FROM clients WHERE id = {ph}", (client_id,))
-        row = _fetchone(cur)
-        if not row:
-            ensure_default_client(client_id)
-            return get_client_config(client_id)
-
-        return {
-            "id": row["id"],
-            "name": row["name"],
-            "opening_hours": json.loads(row["opening_hours_json"]),
-            "faq": json.loads(row["faq_json"]),
-        }
+        return _fetchone(cur)
+    finally:
+        conn.close()
+
+
+def get_client_config(client_id: str):
+    # Une connexion à la fois : la première est rendue avant la création du client
+    row = _fetch_client_row(client_id)
+    if not row:
+        ensure_default_client(client_id)
+        row = _fetch_client_row(client_id)
+
+    from capacity import normalize_capacity
+    capacity_json = row["capacity_json"] if "capacity_json" in row.keys() else None
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "opening_hours": json.loads(row["opening_hours_json"]),
+        "faq": json.loads(row["faq_json"]),
+        "capacity": normalize_capacity(json.loads(capacity_json) if capacity_json else None),
+    }
+
+
+def set_client_capacity(client_id: str, capacity: dict):
+    """Enregistre la config de capacité (ponts, durées par prestation, agendas)."""
+    ensure_default_client(client_id)
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"UPDATE clients SET capacity_json = {ph} WHERE id = {ph}", (json.dumps(capacity), client_id))
+        conn.commit()
     finally:
         conn.close()
 
@@ -231,57 +511,100 @@ def get_session(client_id: str, user_id: str):
         conn.close()
 
 
-def clear_session(client_id: str, user_id: str):
+@contextmanager
+def session_turn_lock(client_id: str, user_id: str):
+    """
+    Verrou du tour d'un visiteur, partagé par tous les workers (Postgres : verrou
+    consultatif de session, pris sur une connexion du pool de verrous en autocommit,
+    donc pas de transaction ouverte pendant le tour).
+    Le tour utilise le pool principal pour ses requêtes : le verrou ne le prive d'aucune connexion.
+    SQLite (local, un seul processus) : rien, le verrou asyncio suffit.
+    """
+    if _is_sqlite():
+        yield
+        return
+    pool = _get_lock_pool()
+    slots = _lock_slots
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT_SECONDS):
+        raise PoolExhaustedError(f"{DB_LOCK_POOL_MAX} tours déjà en cours depuis {DB_POOL_TIMEOUT_SECONDS:.0f} s")
+    key = f"session:{client_id}:{user_id}"
+    try:
+        conn = pool.getconn()
+    except Exception:
+        slots.release()
+        raise
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_lock(hashtext(%s))", (key,))
+    except Exception:
+        pool.putconn(conn, close=True)
+        slots.release()
+        raise
+    broken = False
+    try:
+        yield
+    finally:
+        try:
+            cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (key,))
+        except Exception as e:
+            # Verrou peut-être encore tenu : la connexion est fermée, ce qui le libère
+            print("⚠️ Erreur libération verrou de tour :", repr(e))
+            broken = True
+        pool.putconn(conn, close=broken or bool(conn.closed))
+        slots.release()
+
+
+def get_last_turn(client_id: str, user_id: str):
+    """Dernier message traité pour ce visiteur : {"message_hash", "reply_json", "at"} ou None."""
     conn = get_conn()
     ph = _ph()
     try:
         cur = conn.cursor()
-        cur.execute(f"DELETE FROM sessions WHERE client_id={ph} AND user_id={ph}", (client_id, user_id))
-        conn.commit()
+        cur.execute(
+            f"SELECT last_message_hash, last_reply_json, last_message_at FROM sessions WHERE client_id={ph} AND user_id={ph}",
+            (client_id, user_id),
+        )
+        row = _fetchone(cur)
+        if not row or not row["last_message_hash"]:
+            return None
+        return {"message_hash": row["last_message_hash"], "reply_json": row["last_reply_json"], "at": row["last_message_at"]}
     finally:
         conn.close()
 
 
-def appointment_exists(client_id: str, date: str, time: str) -> bool:
+def save_last_turn(client_id: str, user_id: str, message_hash: str, reply_json: str):
+    """Mémorise le message traité et sa réponse (la session peut avoir été effacée pendant le tour)."""
     conn = get_conn()
     ph = _ph()
+    now = datetime.utcnow().isoformat()
     try:
         cur = conn.cursor()
         cur.execute(
-            f"SELECT 1 FROM appointments WHERE client_id={ph} AND date={ph} AND time={ph} LIMIT 1",
-            (client_id, date, time),
+            f"""
+            INSERT INTO sessions (client_id, user_id, stage, draft_json, updated_at, last_message_hash, last_reply_json, last_message_at)
+            VALUES ({ph}, {ph}, 'idle', '{{}}', {ph}, {ph}, {ph}, {ph})
+            ON CONFLICT(client_id, user_id)
+            DO UPDATE SET
+                last_message_hash=excluded.last_message_hash,
+                last_reply_json=excluded.last_reply_json,
+                last_message_at=excluded.last_message_at,
+                updated_at=excluded.updated_at
+            """,
+            (client_id, user_id, now, message_hash, reply_json, now),
         )
-        return cur.fetchone() is not None
+        conn.commit()
     finally:
         conn.close()
 
 
-def insert_appointment(client_id: str, user_id: str, name: str, date: str, time: str) -> bool:
-    """True si inséré, False si déjà existant."""
+def clear_session(client_id: str, user_id: str):
     conn = get_conn()
+    ph = _ph()
     try:
         cur = conn.cursor()
-        if _is_sqlite():
-            cur.execute(
-                """
-                INSERT OR IGNORE INTO appointments (client_id, user_id, name, date, time, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (client_id, user_id, name, date, time, datetime.utcnow().isoformat()),
-            )
-            conn.commit()
-            return cur.rowcount == 1
-        else:
-            cur.execute(
-                """
-                INSERT INTO appointments (client_id, user_id, name, date, time, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (client_id, date, time) DO NOTHING
-                """,
-                (client_id, user_id, name, date, time, datetime.utcnow().isoformat()),
-            )
-            conn.commit()
-            return cur.rowcount == 1
+        cur.execute(f"DELETE FROM sessions WHERE client_id={ph} AND user_id={ph}", (client_id, user_id))
+        conn.commit()
     finally:
         conn.close()
 
@@ -290,10 +613,10 @@ def insert_appointment(client_id: str, user_id: str, name: str, date: str, time:
 # Google credentials
 # ---------------------------
 
-def _add_google_column_if_missing():
+def _add_column_if_missing(table: str, column: str, col_type: str = "TEXT"):
     """
     Sécurisé SQLite + Postgres.
-    Utile si tu as déjà une vieille DB sans la colonne google_credentials.
+    Ajoute une colonne à une vieille DB créée avant son introduction.
     """
     conn = get_conn()
     try:
@@ -301,10 +624,10 @@ def _add_google_column_if_missing():
 
         if _is_sqlite():
             # SQLite: inspect table columns
-            cur.execute("PRAGMA table_info(clients)")
+            cur.execute(f"PRAGMA table_info({table})")
             cols = [r[1] for r in cur.fetchall()]
-            if "google_credentials" not in cols:
-                cur.execute("ALTER TABLE clients ADD COLUMN google_credentials TEXT")
+            if column not in cols:
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}")
                 conn.commit()
             return
 
@@ -312,17 +635,22 @@ def _add_google_column_if_missing():
         cur.execute("""
             SELECT 1
             FROM information_schema.columns
-            WHERE table_name='clients' AND column_name='google_credentials'
+            WHERE table_name=%s AND column_name=%s
             LIMIT 1
-        """)
+        """, (table, column))
         if cur.fetchone() is None:
-            cur.execute("ALTER TABLE clients ADD COLUMN google_credentials TEXT")
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}")
             conn.commit()
 
     finally:
         conn.close()
 
 
+def _add_google_column_if_missing():
+    """Utile si tu as déjà une vieille DB sans la colonne google_credentials."""
+    _add_column_if_missing("clients", "google_credentials")
+
+
 def save_google_credentials(client_id: str, credentials_dict: dict):
     """
     Stocke les credentials Google dans clients.google_credentials (JSON).
@@ -377,3 +705,654 @@ def get_google_credentials(client_id: str):
         return None
     finally:
         conn.close()
+
+
+# ---------------------------
+# Maintenance (rétention / archivage)
+# ---------------------------
+
+def fetch_messages_before(cutoff_iso: str, limit: int = 500):
+    """Lot des plus anciens messages créés avant cutoff_iso (ordre d'id croissant)."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT id, client_id, user_id, role, content, created_at FROM messages
+            WHERE created_at < {ph}
+            ORDER BY id ASC
+            LIMIT {int(limit)}
+            """,
+            (cutoff_iso,),
+        )
+        rows = cur.fetchall() or []
+        return [dict(r) for r in rows]
+    finally:
+        conn.close()
+
+
+def delete_messages_by_ids(ids) -> int:
+    """Supprime les messages dont l'id est dans ids. Retourne le nombre de lignes supprimées."""
+    ids = [int(i) for i in ids]
+    if not ids:
+        return 0
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        placeholders = ", ".join([ph] * len(ids))
+        cur.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", ids)
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+def delete_sessions_before(cutoff_iso: str) -> int:
+    """Supprime les sessions non mises à jour depuis cutoff_iso."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM sessions WHERE updated_at < {ph}", (cutoff_iso,))
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+# ---------------------------
+# Table des créneaux libres
+# ---------------------------
+
+def list_clients():
+    """Ids de tous les clients."""
+    conn = get_conn()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM clients")
+        return [r["id"] for r in (cur.fetchall() or [])]
+    finally:
+        conn.close()
+
+
+def list_google_clients():
+    """Ids des clients ayant lié un agenda Google."""
+    conn = get_conn()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM clients WHERE google_credentials IS NOT NULL AND google_credentials <> ''")
+        return [r["id"] for r in (cur.fetchall() or [])]
+    finally:
+        conn.close()
+
+
+def upsert_slot_days(client_id: str, days: list, refreshed_at: str):
+    """
+    days = [(date, busy_json, free_json), ...] ; une transaction par client.
+    refreshed_at (ISO UTC) : date de la lecture Google ; une ligne plus récente n'est pas écrasée.
+    """
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        for date, busy_json, free_json in days:
+            cur.execute(
+                f"""
+                INSERT INTO slot_table (client_id, date, busy_json, free_json, refreshed_at)
+                VALUES ({ph}, {ph}, {ph}, {ph}, {ph})
+                ON CONFLICT(client_id, date)
+                DO UPDATE SET
+                    busy_json=excluded.busy_json,
+                    free_json=excluded.free_json,
+                    refreshed_at=excluded.refreshed_at
+                WHERE slot_table.refreshed_at <= excluded.refreshed_at
+                """,
+                (client_id, date, busy_json, free_json, refreshed_at),
+            )
+        if days:
+            # On oublie les jours passés
+            cur.execute(f"DELETE FROM slot_table WHERE client_id={ph} AND date < {ph}", (client_id, days[0][0]))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def get_slot_days():
+    """Toutes les lignes de slot_table (chargement du cache au démarrage)."""
+    conn = get_conn()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT client_id, date, busy_json, free_json, refreshed_at FROM slot_table")
+        return [dict(r) for r in (cur.fetchall() or [])]
+    finally:
+        conn.close()
+
+
+# ---------------------------
+# Outbox (création d'événements Google différée)
+# ---------------------------
+
+def _minutes(time_str: str) -> int:
+    hours, minutes = time_str.split(":")[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def create_appointment_with_outbox(
+    client_id: str, user_id: str, name: str, date: str, time: str, payload: dict,
+    duration_mins: int = 60, resources: int = 1, default_duration: int = 60,
+):
+    """
+    Insère le RDV et son entrée d'outbox dans UNE transaction, sur un pont (bay) libre
+    pendant tout [heure, heure + durée). La journée du client est verrouillée pendant la
+    vérification (Postgres : verrou consultatif, SQLite : BEGIN IMMEDIATE).
+    Retourne l'id du RDV, ou None si les `resources` ponts sont déjà pris sur ce créneau.
+    """
+    conn = get_conn()
+    ph = _ph()
+    now = datetime.utcnow().isoformat()
+    try:
+        cur = conn.cursor()
+        if _is_sqlite():
+            cur.execute("BEGIN IMMEDIATE")
+        else:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"booking:{client_id}:{date}",))
+
+        # Capacité : RDV pas encore dans Google qui chevauchent le nouveau (durée inconnue :
+        # durée par défaut). Ceux déjà dans Google ont été vérifiés sur leur événement (le garage
+        # a pu le déplacer ou le supprimer) ; ils ne gardent que leur numéro de pont à la même heure (UNIQUE).
+        start = _minutes(time)
+        end = start + duration_mins
+        cur.execute(
+            f"SELECT time, duration_mins, bay, google_event_id FROM appointments WHERE client_id={ph} AND date={ph}",
+            (client_id, date),
+        )
+        overlapping = 0
+        taken = set()
+        for row in cur.fetchall():
+            row_start = _minutes(row["time"])
+            if row["google_event_id"] is None and row_start < end and start < row_start + (row["duration_mins"] or default_duration):
+                overlapping += 1
+                taken.add(row["bay"])
+            elif row["time"] == time:
+                taken.add(row["bay"])
+        free = [] if overlapping >= resources else [min(set(range(len(taken) + 1)) - taken)]
+
+        appointment_id = None
+        if free:
+            if _is_sqlite():
+                cur.execute(
+                    """
+                    INSERT OR IGNORE INTO appointments (client_id, user_id, name, date, time, created_at, bay, duration_mins)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (client_id, user_id, name, date, time, now, free[0], duration_mins),
+                )
+                if cur.rowcount == 1:
+                    appointment_id = cur.lastrowid
+            else:
+                cur.execute(
+                    """
+                    INSERT INTO appointments (client_id, user_id, name, date, time, created_at, bay, duration_mins)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (client_id, date, time, bay) DO NOTHING
+                    RETURNING id
+                    """,
+                    (client_id, user_id, name, date, time, now, free[0], duration_mins),
+                )
+                row = cur.fetchone()
+                if row is not None:
+                    appointment_id = row["id"]
+
+        if appointment_id is None:
+            conn.rollback()
+            return None
+
+        cur.execute(
+            f"""
+            INSERT INTO outbox (client_id, appointment_id, kind, payload_json, status, attempts, next_attempt_at, created_at)
+            VALUES ({ph}, {ph}, {ph}, {ph}, 'pending', 0, {ph}, {ph})
+            """,
+            (client_id, appointment_id, "google_event", json.dumps(payload), now, now),
+        )
+        conn.commit()
+        return appointment_id
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def get_day_appointments(client_id: str, date: str, pending_only: bool = False):
+    """
+    RDV locaux du jour : [(heure, durée ou None), ...].
+    pending_only : seulement ceux pas encore envoyés à Google (outbox en attente).
+    """
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT time, duration_mins FROM appointments
+            WHERE client_id={ph} AND date={ph} {"AND google_event_id IS NULL" if pending_only else ""}
+            """,
+            (client_id, date),
+        )
+        return [(r["time"], r["duration_mins"]) for r in (cur.fetchall() or [])]
+    finally:
+        conn.close()
+
+
+def get_appointments_between(client_id: str, first_date: str, last_date: str, pending_only: bool = False) -> dict:
+    """
+    RDV locaux sur [first_date, last_date] : {date: [(heure, durée ou None), ...]}.
+    pending_only : seulement ceux pas encore envoyés à Google (outbox en attente).
+    """
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT date, time, duration_mins FROM appointments
+            WHERE client_id={ph} AND date >= {ph} AND date <= {ph} {"AND google_event_id IS NULL" if pending_only else ""}
+            """,
+            (client_id, first_date, last_date),
+        )
+        by_day = {}
+        for r in cur.fetchall() or []:
+            by_day.setdefault(r["date"], []).append((r["time"], r["duration_mins"]))
+        return by_day
+    finally:
+        conn.close()
+
+
+def claim_outbox(limit: int, lease_seconds: int):
+    """
+    Réserve jusqu'à `limit` entrées dues (pending, ou sending dont le bail a expiré).
+    La réservation est un UPDATE conditionnel : deux workers ne prennent jamais la même entrée.
+    """
+    conn = get_conn()
+    ph = _ph()
+    now = datetime.utcnow()
+    lease_until = (now + timedelta(seconds=lease_seconds)).isoformat()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT id, client_id, appointment_id, kind, payload_json, attempts, next_attempt_at, created_at FROM outbox
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= {ph}
+            ORDER BY id ASC
+            LIMIT {int(limit)}
+            """,
+            (now.isoformat(),),
+        )
+        candidates = [dict(r) for r in (cur.fetchall() or [])]
+
+        claimed = []
+        for row in candidates:
+            cur.execute(
+                f"""
+                UPDATE outbox SET status='sending', next_attempt_at={ph}
+                WHERE id={ph} AND status IN ('pending', 'sending') AND next_attempt_at={ph}
+                """,
+                (lease_until, row["id"], row["next_attempt_at"]),
+            )
+            if cur.rowcount == 1:
+                row["payload"] = json.loads(row.pop("payload_json"))
+                claimed.append(row)
+        conn.commit()
+        return claimed
+    finally:
+        conn.close()
+
+
+def complete_outbox(outbox_id: int, appointment_id: int, event_id: str, html_link: str):
+    """Envoi réussi : l'entrée passe en done et le RDV reçoit l'id/lien Google (même transaction)."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"UPDATE outbox SET status='done', processed_at={ph}, last_error=NULL WHERE id={ph}",
+            (datetime.utcnow().isoformat(), outbox_id),
+        )
+        cur.execute(
+            f"UPDATE appointments SET google_event_id={ph}, google_link={ph} WHERE id={ph}",
+            (event_id, html_link, appointment_id),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def retry_outbox(outbox_id: int, attempts: int, next_attempt_at: str, error: str, failed: bool = False):
+    """Échec : nouvelle tentative planifiée, ou abandon (failed) après trop d'essais."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            UPDATE outbox SET status={ph}, attempts={ph}, next_attempt_at={ph}, last_error={ph}
+            WHERE id={ph}
+            """,
+            ("failed" if failed else "pending", attempts, next_attempt_at, error[:500], outbox_id),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def delete_outbox_done_before(cutoff_iso: str) -> int:
+    """Purge des entrées d'outbox déjà envoyées (maintenance)."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM outbox WHERE status='done' AND processed_at < {ph}", (cutoff_iso,))
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+def get_failed_outbox(limit: int = 50):
+    """Entrées abandonnées (le visiteur a eu "✅ Confirmé" mais le RDV n'est pas dans Google), avec leur RDV."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT o.id, o.client_id, o.appointment_id, o.attempts, o.last_error, o.created_at,
+                   a.name, a.date, a.time
+            FROM outbox o JOIN appointments a ON a.id = o.appointment_id
+            WHERE o.status='failed'
+            ORDER BY o.created_at DESC
+            LIMIT {ph}
+            """,
+            (limit,),
+        )
+        return [dict(r) for r in (cur.fetchall() or [])]
+    finally:
+        conn.close()
+
+
+def outbox_stats():
+    """Nombre d'entrées par statut et date de création de la plus ancienne non envoyée."""
+    conn = get_conn()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT status, COUNT(*) AS n FROM outbox WHERE status <> 'done' GROUP BY status")
+        counts = {r["status"]: r["n"] for r in (cur.fetchall() or [])}
+        cur.execute("SELECT MIN(created_at) AS oldest FROM outbox WHERE status IN ('pending', 'sending')")
+        row = _fetchone(cur)
+        return {"counts": counts, "oldest_pending": row["oldest"] if row else None}
+    finally:
+        conn.close()
+
+
+# ---------------------------
+# Statistiques (rollups journaliers)
+# ---------------------------
+
+def _increment_stats(cur, client_id: str, day: str, increments: dict):
+    ph = _ph()
+    for metric, n in increments.items():
+        if not n:
+            continue
+        cur.execute(
+            f"""
+            INSERT INTO daily_stats (client_id, day, metric, count)
+            VALUES ({ph}, {ph}, {ph}, {ph})
+            ON CONFLICT(client_id, day, metric)
+            DO UPDATE SET count = daily_stats.count + excluded.count
+            """,
+            (client_id, day, metric, int(n)),
+        )
+
+
+def record_daily_stats(client_id: str, day: str, user_id: str, increments: dict):
+    """
+    Incrémente les compteurs du jour (une transaction).
+    Le premier message d'un visiteur dans la journée compte une conversation.
+    """
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            INSERT INTO daily_visitors (client_id, day, user_id)
+            VALUES ({ph}, {ph}, {ph})
+            ON CONFLICT(client_id, day, user_id) DO NOTHING
+            """,
+            (client_id, day, user_id),
+        )
+        if cur.rowcount == 1:
+            increments = dict(increments, conversations=increments.get("conversations", 0) + 1)
+        _increment_stats(cur, client_id, day, increments)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def replace_daily_stats(client_id: str, day: str, counts: dict, metrics: list):
+    """Backfill : remplace les compteurs `metrics` du jour par `counts`."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        placeholders = ", ".join([ph] * len(metrics))
+        cur.execute(
+            f"DELETE FROM daily_stats WHERE client_id={ph} AND day={ph} AND metric IN ({placeholders})",
+            (client_id, day, *metrics),
+        )
+        _increment_stats(cur, client_id, day, counts)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def get_daily_stats(client_id: str, since_day: str):
+    """Compteurs depuis since_day (inclus) : [{"day", "metric", "count"}, ...]."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT day, metric, count FROM daily_stats
+            WHERE client_id={ph} AND day >= {ph}
+            ORDER BY day ASC
+            """,
+            (client_id, since_day),
+        )
+        return [dict(r) for r in (cur.fetchall() or [])]
+    finally:
+        conn.close()
+
+
+def fetch_messages_after(last_id: int, limit: int = 500):
+    """Lot de messages d'id > last_id (parcours complet de la table par lots)."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT id, client_id, user_id, role, content, created_at FROM messages
+            WHERE id > {ph}
+            ORDER BY id ASC
+            LIMIT {int(limit)}
+            """,
+            (int(last_id),),
+        )
+        return [dict(r) for r in (cur.fetchall() or [])]
+    finally:
+        conn.close()
+
+
+def delete_daily_visitors_before(day: str) -> int:
+    """Purge des visiteurs journaliers (seul le jour courant sert au comptage)."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM daily_visitors WHERE day < {ph}", (day,))
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+
+def acquire_lease(name: str, holder: str, ttl_seconds: float) -> bool:
+    """
+    Prend (ou renouvelle) le bail `name` pour `holder` s'il est libre, expiré ou déjà à lui.
+    True si `holder` détient le bail jusqu'à maintenant + ttl_seconds.
+    """
+    conn = get_conn()
+    ph = _ph()
+    now = datetime.utcnow()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            INSERT INTO leases (name, holder, expires_at) VALUES ({ph}, {ph}, {ph})
+            ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < {ph}
+            """,
+            (name, holder, (now + timedelta(seconds=ttl_seconds)).isoformat(), now.isoformat()),
+        )
+        conn.commit()
+        return cur.rowcount == 1
+    finally:
+        conn.close()
+
+
+def release_lease(name: str, holder: str) -> bool:
+    """Rend le bail `name` s'il est détenu par `holder` (True si rendu)."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM leases WHERE name = {ph} AND holder = {ph}", (name, holder))
+        conn.commit()
+        return cur.rowcount == 1
+    finally:
+        conn.close()
+
+
+def release_leases(holder: str) -> int:
+    """Rend tous les baux détenus par `holder` (arrêt du worker)."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM leases WHERE holder = {ph}", (holder,))
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+def get_app_setting(key: str):
+    """Valeur (JSON décodé) d'un réglage partagé, ou None."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"SELECT value_json FROM app_settings WHERE key = {ph}", (key,))
+        row = _fetchone(cur)
+        return json.loads(row["value_json"]) if row else None
+    finally:
+        conn.close()
+
+
+def set_app_setting(key: str, value):
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            INSERT INTO app_settings (key, value_json, updated_at) VALUES ({ph}, {ph}, {ph})
+            ON CONFLICT (key) DO UPDATE SET value_json = excluded.value_json, updated_at = excluded.updated_at
+            """,
+            (key, json.dumps(value), datetime.utcnow().isoformat()),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def save_profile(profile: dict, keep: int) -> int:
+    """Enregistre un profil de tour et ne garde que les `keep` plus récents. Retourne son id."""
+    conn = get_conn()
+    ph = _ph()
+    values = (
+        profile["client_id"], profile["user_id"], profile["worker"], profile["reason"],
+        profile["started_at"], profile["duration_ms"], json.dumps(profile["breakdown_ms"]), json.dumps(profile),
+    )
+    try:
+        cur = conn.cursor()
+        sql = f"""
+            INSERT INTO profiles (client_id, user_id, worker, reason, started_at, duration_ms, breakdown_json, data_json)
+            VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+        """
+        if _is_sqlite():
+            cur.execute(sql, values)
+            profile_id = cur.lastrowid
+        else:
+            cur.execute(sql + " RETURNING id", values)
+            profile_id = cur.fetchone()["id"]
+        cur.execute(
+            f"DELETE FROM profiles WHERE id NOT IN (SELECT id FROM profiles ORDER BY id DESC LIMIT {int(keep)})"
+        )
+        conn.commit()
+        return profile_id
+    finally:
+        conn.close()
+
+
+def list_profiles(limit: int = 50):
+    """Résumés des derniers profils (sans le détail des appels)."""
+    conn = get_conn()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT id, client_id, user_id, worker, reason, started_at, duration_ms, breakdown_json
+            FROM profiles ORDER BY id DESC LIMIT {int(limit)}
+            """
+        )
+        rows = [dict(r) for r in (cur.fetchall() or [])]
+        for r in rows:
+            r["breakdown_ms"] = json.loads(r.pop("breakdown_json"))
+        return rows
+    finally:
+        conn.close()
+
+
+def get_profiles(ids=None):
+    """Profils complets ({..., "spans": [...]}) : ceux de `ids`, ou tous ceux gardés."""
+    conn = get_conn()
+    ph = _ph()
+    try:
+        cur = conn.cursor()
+        if ids is None:
+            cur.execute("SELECT id, data_json FROM profiles ORDER BY id")
+        else:
+            ids = [int(i) for i in ids] or [0]
+            cur.execute(f"SELECT id, data_json FROM profiles WHERE id IN ({', '.join([ph] * len(ids))}) ORDER BY id", ids)
+        return [{**json.loads(r["data_json"]), "id": r["id"]} for r in (cur.fetchall() or [])]
+    finally:
+        conn.close()
+
+# Profilage à la demande : chaque fonction publique est chronométrée dans les tours profilés
+profiler.instrument(globals(), "db")
@@ -1,24 +1,54 @@
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+import os
 import datetime
+import threading
 from zoneinfo import ZoneInfo
 
+from resilience import CircuitBreaker
+from singleflight import SingleFlight
+import profiler
+
+try:
+    from config import GOOGLE_TIMEOUT_SECONDS, BREAKER_OPEN_SECONDS, SINGLEFLIGHT_TTL_SECONDS
+except ImportError:
+    GOOGLE_TIMEOUT_SECONDS = float(os.getenv("GOOGLE_TIMEOUT_SECONDS", "5"))
+    BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+    SINGLEFLIGHT_TTL_SECONDS = float(os.getenv("SINGLEFLIGHT_TTL_SECONDS", "2"))
+
 TZ = ZoneInfo("Europe/Paris")
 
+# Préfixe des ids d'événements créés par le bot (ids déterministes, cf. outbox)
+BOT_EVENT_ID_PREFIX = "rdvbot"
+
+# Disjoncteur partagé par tous les appels Google Calendar
+google_breaker = CircuitBreaker("google_calendar", open_seconds=BREAKER_OPEN_SECONDS)
+
+
+# Requêtes identiques simultanées (même client, même opération, même fenêtre) : un seul appel Google
+busy_flight = SingleFlight("google_busy", ttl=SINGLEFLIGHT_TTL_SECONDS)
+token_flight = SingleFlight("google_token_refresh", ttl=SINGLEFLIGHT_TTL_SECONDS)
+
+# Service Calendar par thread et par client : httplib2.Http n'est pas thread-safe, et réutiliser
+# le service garde sa connexion HTTPS ouverte d'un appel à l'autre. Reconstruit quand le token change.
+_services = threading.local()
+
+
+def google_degraded() -> bool:
+    """
+    True si Google Calendar est considéré indisponible : circuit ouvert ou en half_open
+    (la sonde est réservée à un seul appel, les autres seraient refusés).
+    """
+    return not google_breaker.is_closed()
+
 
 # =========================================================
 # CONNEXION GOOGLE CALENDAR
 # =========================================================
 
-def get_calendar_service(client_id):
-    """Initialise la connexion avec l'API Google Calendar + refresh auto."""
-    from db import get_google_credentials, save_google_credentials
-
-    creds_dict = get_google_credentials(client_id)
-    if not creds_dict:
-        print(f"⚠️ Aucun identifiant Google trouvé pour {client_id}")
-        return None
+def _refresh_token(client_id, creds_dict):
+    """Rafraîchit le token et le sauvegarde. Retourne le nouveau creds_dict, ou None en cas d'échec."""
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
+    from db import save_google_credentials
 
     creds = Credentials(
         token=creds_dict.get("token"),
@@ -28,22 +58,78 @@ def get_calendar_service(client_id):
         client_secret=creds_dict.get("client_secret"),
         scopes=creds_dict.get("scopes"),
     )
+    try:
+        creds.refresh(Request())
+    except Exception as e:
+        print("❌ Erreur refresh token Google :", repr(e))
+        google_breaker.record_failure()
+        return None
 
-    # 🔄 Refresh automatique si expiré
+    creds_dict = dict(creds_dict, token=creds.token)
+    if creds.expiry:
+        creds_dict["expiry"] = creds.expiry.isoformat()
+    save_google_credentials(client_id, creds_dict)
+    print("🔄 Token Google rafraîchi")
+    return creds_dict
+
+
+def get_calendar_service(client_id):
+    """
+    Service Google Calendar du client (refresh auto du token), mis en cache pour le thread
+    appelant tant que le token ne change pas.
+    """
+    # Imports lourds différés : la pile Google n'est chargée qu'au premier appel (démarrage à froid)
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
+    from db import get_google_credentials
+
+    creds_dict = get_google_credentials(client_id)
+    if not creds_dict:
+        print(f"⚠️ Aucun identifiant Google trouvé pour {client_id}")
+        return None
+
+    def build_creds(d):
+        # expiry (UTC naïf, format google-auth) : sans lui, creds.expired vaut toujours False
+        expiry = d.get("expiry")
+        return Credentials(
+            token=d.get("token"),
+            refresh_token=d.get("refresh_token"),
+            token_uri=d.get("token_uri"),
+            client_id=d.get("client_id"),
+            client_secret=d.get("client_secret"),
+            scopes=d.get("scopes"),
+            expiry=datetime.datetime.fromisoformat(expiry).replace(tzinfo=None) if expiry else None,
+        )
+
+    creds = build_creds(creds_dict)
+
+    # 🔄 Refresh automatique si expiré : un seul refresh (et une seule sauvegarde) par client à la fois
     if creds.expired and creds.refresh_token:
-        try:
-            creds.refresh(Request())
-            creds_dict["token"] = creds.token
-            if creds.expiry:
-                creds_dict["expiry"] = creds.expiry.isoformat()
-            save_google_credentials(client_id, creds_dict)
-            print("🔄 Token Google rafraîchi")
-        except Exception as e:
-            print("❌ Erreur refresh token Google :", repr(e))
+        refreshed = token_flight.do(
+            (client_id, "token_refresh"),
+            lambda: _refresh_token(client_id, creds_dict),
+            cache_if=lambda r: r is not None,
+        )
+        if not refreshed:
             return None
+        creds_dict = refreshed
+        creds = build_creds(refreshed)
+
+    cache = getattr(_services, "by_client", None)
+    if cache is None:
+        cache = _services.by_client = {}
+    cached = cache.get(client_id)
+    if cached and cached[0] == creds_dict.get("token"):
+        return cached[1]
 
     try:
-        return build("calendar", "v3", credentials=creds)
+        # Timeout explicite : un Google lent échoue vite au lieu de bloquer le tour
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=GOOGLE_TIMEOUT_SECONDS))
+        service = build("calendar", "v3", http=http, cache_discovery=False)
+        cache[client_id] = (creds_dict.get("token"), service)
+        return service
     except Exception as e:
         print("❌ Erreur build Google Calendar service :", repr(e))
         return None
@@ -53,77 +139,142 @@ def get_calendar_service(client_id):
 # VÉRIFICATION DISPONIBILITÉ
 # =========================================================
 
-def is_slot_available_google(client_id, date_str, time_str, duration_mins=60):
-    """Vérifie si un créneau est libre (Europe/Paris)."""
-    service = get_calendar_service(client_id)
-    if not service:
-        return False
-
-    day = datetime.date.fromisoformat(date_str)
-    start_of_day = datetime.datetime.combine(day, datetime.time(0, 0), TZ)
-    end_of_day = datetime.datetime.combine(day, datetime.time(23, 59, 59), TZ)
+def get_busy_intervals_range(client_id, start_date_str, days=1, calendar_ids=("primary",)):
+    """
+    Intervalles occupés par jour sur [start_date, start_date + days) (Europe/Paris),
+    tous agendas confondus : {"YYYY-MM-DD": [(début, fin), ...]}.
+    Un intervalle par événement (les chevauchements sont conservés : capacité), y compris
+    ceux créés par le bot : Google fait foi quand le garage déplace ou supprime un RDV.
+    Plusieurs agendas sont lus dans une seule requête batch.
+    None si Google est indisponible (pas de credentials, erreur, circuit ouvert).
+    Les appels identiques simultanés sont fusionnés (single-flight).
+    """
+    calendar_ids = tuple(calendar_ids)
+    return busy_flight.do(
+        (client_id, "events.list", start_date_str, days, calendar_ids),
+        lambda: _fetch_busy_intervals_range(client_id, start_date_str, days, calendar_ids),
+        cache_if=lambda r: r is not None,
+    )
 
-    req_start = datetime.datetime.fromisoformat(f"{date_str}T{time_str}").replace(tzinfo=TZ)
-    req_end = req_start + datetime.timedelta(minutes=duration_mins)
 
-    try:
-        events = service.events().list(
-            calendarId="primary",
-            timeMin=start_of_day.isoformat(),
-            timeMax=end_of_day.isoformat(),
+def _list_events(service, calendar_ids, time_min, time_max):
+    """events.list sur chaque agenda : 1re page de tous les agendas en un batch, pages suivantes ensuite."""
+    def request(calendar_id, page_token=None):
+        return service.events().list(
+            calendarId=calendar_id,
+            timeMin=time_min,
+            timeMax=time_max,
             singleEvents=True,
             orderBy="startTime",
-        ).execute().get("items", [])
+            maxResults=2500,
+            pageToken=page_token,
+        )
+
+    pages = {}
+    if len(calendar_ids) == 1:
+        pages[calendar_ids[0]] = request(calendar_ids[0]).execute()
+    else:
+        errors = []
 
-        for event in events:
-            # Journée entière
-            if "date" in event["start"]:
-                if event["start"]["date"] == date_str:
-                    return False
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors.append(exception)
+            else:
+                pages[request_id] = response
 
-            # Événement horaire
-            if "dateTime" in event["start"]:
-                ev_start = datetime.datetime.fromisoformat(
-                    event["start"]["dateTime"]
-                ).astimezone(TZ)
-                ev_end = datetime.datetime.fromisoformat(
-                    event["end"]["dateTime"]
-                ).astimezone(TZ)
+        batch = service.new_batch_http_request(callback=callback)
+        for calendar_id in calendar_ids:
+            batch.add(request(calendar_id), request_id=calendar_id)
+        batch.execute()
+        if errors:
+            raise errors[0]
 
-                if req_start < ev_end and req_end > ev_start:
-                    return False
+    events = []
+    for calendar_id, page in pages.items():
+        while True:
+            events.extend(page.get("items", []))
+            if not page.get("nextPageToken"):
+                break
+            page = request(calendar_id, page["nextPageToken"]).execute()
+    return events
 
-        return True
 
+def _fetch_busy_intervals_range(client_id, start_date_str, days, calendar_ids):
+    if not google_breaker.allow():
+        return None
+
+    service = get_calendar_service(client_id)
+    if not service:
+        return None
+
+    first_day = datetime.date.fromisoformat(start_date_str)
+    day_list = [first_day + datetime.timedelta(days=i) for i in range(days)]
+    start_of_range = datetime.datetime.combine(first_day, datetime.time(0, 0), TZ)
+    end_of_range = datetime.datetime.combine(day_list[-1], datetime.time(23, 59, 59), TZ)
+
+    try:
+        events = _list_events(service, calendar_ids, start_of_range.isoformat(), end_of_range.isoformat())
+        google_breaker.record_success()
     except Exception as e:
         print("❌ Erreur check Google :", repr(e))
-        return False
+        google_breaker.record_failure()
+        return None
+
+    intervals = []
+    for event in events:
+        # Marqué "Disponible" dans Google (transparent) : n'occupe rien
+        if event.get("transparency") == "transparent":
+            continue
+        # Journée entière (date de fin exclusive)
+        if "date" in event["start"]:
+            ev_start = datetime.datetime.combine(
+                datetime.date.fromisoformat(event["start"]["date"]), datetime.time(0, 0), TZ
+            )
+            ev_end = datetime.datetime.combine(
+                datetime.date.fromisoformat(event["end"]["date"]), datetime.time(0, 0), TZ
+            )
+            intervals.append((ev_start, ev_end))
+
+        # Événement horaire
+        if "dateTime" in event["start"]:
+            ev_start = datetime.datetime.fromisoformat(
+                event["start"]["dateTime"]
+            ).astimezone(TZ)
+            ev_end = datetime.datetime.fromisoformat(
+                event["end"]["dateTime"]
+            ).astimezone(TZ)
+            intervals.append((ev_start, ev_end))
+
+    # Répartition par jour (un événement sur plusieurs jours apparaît dans chacun)
+    busy_by_day = {}
+    for day in day_list:
+        day_start = datetime.datetime.combine(day, datetime.time(0, 0), TZ)
+        day_end = day_start + datetime.timedelta(days=1)
+        busy_by_day[day.isoformat()] = [
+            (ev_start, ev_end) for ev_start, ev_end in intervals if ev_start < day_end and ev_end > day_start
+        ]
+    return busy_by_day
+
+
+def get_busy_intervals(client_id, date_str, calendar_ids=("primary",)):
+    """Intervalles occupés [(début, fin), ...] du jour, ou None si Google est indisponible."""
+    busy_by_day = get_busy_intervals_range(client_id, date_str, days=1, calendar_ids=calendar_ids)
+    if busy_by_day is None:
+        return None
+    return busy_by_day[date_str]
 
 
 # =========================================================
 # CRÉATION ÉVÉNEMENT
 # =========================================================
 
-def create_google_event(
-    client_id,
-    date_str,
-    time_str,
-    summary,
-    description="Rendez-vous via Bot",
-    duration_mins=60,
-):
-    """Crée un événement Google Calendar en Europe/Paris."""
-    service = get_calendar_service(client_id)
-    if not service:
-        print("❌ Service Google indisponible")
-        return None
-
+def _event_body(date_str, time_str, summary, description, duration_mins, event_id=None):
     start_dt = datetime.datetime.fromisoformat(
         f"{date_str}T{time_str}"
     ).replace(tzinfo=TZ)
     end_dt = start_dt + datetime.timedelta(minutes=duration_mins)
 
-    event_body = {
+    body = {
         "summary": summary,
         "description": description,
         "start": {
@@ -135,17 +286,71 @@ def create_google_event(
             "timeZone": "Europe/Paris",
         },
     }
+    if event_id:
+        # Id choisi par nous : une nouvelle tentative après un timeout ne crée pas de doublon (409)
+        body["id"] = event_id
+    return body
+
+
+# Limite Google : 50 requêtes par batch HTTP
+BATCH_MAX = 50
+
+
+def create_google_events_batch(client_id, events):
+    """
+    Crée plusieurs événements en un seul appel HTTP (batch Google).
+    events : [{"event_id", "date", "time", "summary", "description", "duration_mins", "calendar_id"?}, ...]
+    Retourne [(event | None, erreur | None), ...] dans le même ordre,
+    ou None si Google est indisponible (pas de credentials, circuit ouvert).
+    Un événement déjà existant (409, tentative précédente arrivée à Google) est relu et compté comme créé.
+    """
+    from googleapiclient.errors import HttpError
+
+    if not google_breaker.allow():
+        return None
+
+    service = get_calendar_service(client_id)
+    if not service:
+        return None
+
+    results = [(None, "non traité")] * len(events)
+    conflicts = []
+
+    def make_callback(index):
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[index] = (response, None)
+            elif isinstance(exception, HttpError) and exception.resp.status == 409:
+                conflicts.append(index)
+            else:
+                results[index] = (None, repr(exception))
+        return callback
 
     try:
-        print("🟦 Création événement Google :", summary, date_str, time_str)
-        event = service.events().insert(
-            calendarId="primary",
-            body=event_body,
-        ).execute()
+        for start in range(0, len(events), BATCH_MAX):
+            batch = service.new_batch_http_request()
+            for index in range(start, min(start + BATCH_MAX, len(events))):
+                ev = events[index]
+                body = _event_body(ev["date"], ev["time"], ev["summary"], ev["description"], ev["duration_mins"], ev.get("event_id"))
+                calendar_id = ev.get("calendar_id", "primary")
+                batch.add(service.events().insert(calendarId=calendar_id, body=body), callback=make_callback(index))
+            batch.execute()
 
-        print("🟩 Événement Google créé :", event.get("id"))
-        return event.get("htmlLink")
+        for index in conflicts:
+            existing = service.events().get(
+                calendarId=events[index].get("calendar_id", "primary"), eventId=events[index]["event_id"]
+            ).execute()
+            results[index] = (existing, None)
 
+        google_breaker.record_success()
     except Exception as e:
-        print("❌ Erreur création Google Calendar :", repr(e))
-        return None
+        print("❌ Erreur batch Google Calendar :", repr(e))
+        google_breaker.record_failure()
+        return [(r, err) if r is not None else (None, repr(e)) for r, err in results]
+
+    print(f"🟩 {sum(1 for r, _ in results if r)} / {len(events)} événement(s) Google créé(s) pour {client_id}")
+    return results
+
+
+# Profilage à la demande (les appels réseau réels sont dans les fonctions privées)
+profiler.instrument(globals(), "google", include=("_refresh_token", "_fetch_busy_intervals_range", "_list_events"))
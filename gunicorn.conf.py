@@ -0,0 +1,36 @@
+# Serveur de production : gunicorn (gestion des processus) + workers uvicorn (ASGI)
+# Lancement : gunicorn main:app -c gunicorn.conf.py
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", min(4, multiprocessing.cpu_count() * 2 + 1)))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Le code est importé une fois dans le master puis partagé (copy-on-write) par les workers.
+# Les piles Google/OpenAI/NumPy restent importées à la demande (PRELOAD_HEAVY_MODULES=1 :
+# importées dans le master, cf. on_starting). Les connexions (pool DB, client OpenAI) sont ouvertes dans chaque worker au warmup.
+preload_app = True
+
+# Arrêt propre : SIGTERM -> plus de nouvelles connexions, on laisse finir les conversations
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
+
+
+def on_starting(server):
+    # Schéma + migrations une seule fois, dans le master, avant le fork des workers
+    # (des CREATE/ALTER concurrents dans chaque worker peuvent échouer sur Postgres)
+    from db import init_db, close_pool
+    init_db()
+    close_pool()
+    os.environ["DB_SCHEMA_READY"] = "1"
+
+    # Optionnel : piles lourdes importées avant le fork (mémoire partagée, démarrage plus lent)
+    from config import PRELOAD_HEAVY_MODULES
+    if server.cfg.preload_app and PRELOAD_HEAVY_MODULES:
+        from lifecycle import preload_heavy_modules
+        preload_heavy_modules()
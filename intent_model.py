@@ -0,0 +1,366 @@
+"""
+Classifieur d'intention local (NumPy) entraîné sur nos propres conversations.
+
+    python intent_model.py train              # entraîne sur `messages`, évalue, sauvegarde
+    python intent_model.py eval               # évalue le modèle sauvegardé sur le jeu de test
+
+Étiquettes : la branche de la réponse du bot qui a suivi chaque message visiteur
+(mêmes règles que les stats, cf. analytics.classify_reply), c'est-à-dire la décision
+prise en production, majoritairement par le LLM. En cours de prise de RDV, la branche
+booking_attempt est imposée par l'étape et non par le message : ces cas sont écartés.
+Modèle : n-grammes (mots + caractères) hachés dans N_FEATURES cases, régression
+logistique multinomiale. Le jeu de test regroupe ~20 % des visiteurs (jamais vus à l'entraînement).
+"""
+import argparse
+import os
+import re
+import statistics
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter
+from datetime import datetime
+
+from db import fetch_messages_after
+from analytics import classify_reply
+
+try:
+    from config import INTENT_MODEL_PATH, INTENT_CONFIDENCE, MAINTENANCE_BATCH_SIZE
+except ImportError:
+    INTENT_MODEL_PATH = os.getenv("INTENT_MODEL_PATH", "intent_model.npz")
+    INTENT_CONFIDENCE = float(os.getenv("INTENT_CONFIDENCE", "0.85"))
+    MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "500"))
+
+N_FEATURES = 2 ** 16
+CHAR_NGRAMS = (3, 4, 5)
+TEST_FRACTION = 0.2
+
+# Branche de la réponse -> intention (mêmes intentions que le LLM)
+BRANCH_TO_INTENT = {
+    "faq": "FAQ",
+    "booking_attempt": "BOOK_APPOINTMENT",
+    "confirmation": "CONFIRM",
+    "confirmation_pending": "CONFIRM",
+    "cancellation": "CANCEL",
+    "other": "OTHER",
+}
+
+# Modèle chargé en mémoire : {"W", "b", "classes", "meta"}
+_model = None
+_lock = threading.Lock()
+
+
+# =========================================================
+# FEATURES
+# =========================================================
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"\d", "0", text)  # "14h30" et "09h00" -> même forme
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def featurize(text: str):
+    """(indices, valeurs) : n-grammes hachés (crc32, stable entre processus), norme L2 = 1."""
+    norm = normalize(text)
+    grams = ["w:" + w for w in norm.split()]
+    padded = f" {norm} "
+    for n in CHAR_NGRAMS:
+        grams.extend("c:" + padded[i:i + n] for i in range(len(padded) - n + 1))
+
+    counts = Counter(zlib.crc32(g.encode("utf-8")) % N_FEATURES for g in grams)
+    if not counts:
+        return [], []
+    norm2 = sum(v * v for v in counts.values()) ** 0.5
+    return list(counts.keys()), [v / norm2 for v in counts.values()]
+
+
+def _vectorize(texts):
+    """Matrice creuse au format CSR : (indptr, indices, values)."""
+    import numpy as np
+
+    indptr, indices, values = [0], [], []
+    for text in texts:
+        idx, val = featurize(text)
+        indices.extend(idx)
+        values.extend(val)
+        indptr.append(len(indices))
+    return (
+        np.asarray(indptr, dtype=np.int64),
+        np.asarray(indices, dtype=np.int64),
+        np.asarray(values, dtype=np.float32),
+    )
+
+
+def _scores(W, b, X):
+    import numpy as np
+
+    indptr, indices, values = X
+    n = len(indptr) - 1
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    out = np.tile(b, (n, 1))
+    np.add.at(out, rows, W[indices] * values[:, None])
+    return out
+
+
+def _softmax(z):
+    import numpy as np
+
+    z = z - z.max(axis=1, keepdims=True)
+    e = np.exp(z)
+    return e / e.sum(axis=1, keepdims=True)
+
+
+# =========================================================
+# DONNÉES
+# =========================================================
+
+def load_dataset(batch_size: int = MAINTENANCE_BATCH_SIZE):
+    """[(client_id, user_id, message, intention)] : chaque message visiteur étiqueté par la réponse suivante."""
+    samples = []
+    pending = {}  # (client_id, user_id) -> dernier message visiteur sans réponse
+    in_flow = set()  # visiteurs en cours de prise de RDV (étape collecting/confirming)
+    last_id = 0
+    while True:
+        rows = fetch_messages_after(last_id, limit=batch_size)
+        if not rows:
+            break
+        for r in rows:
+            key = (r["client_id"], r["user_id"])
+            if r["role"] == "user":
+                pending[key] = r["content"]
+            elif r["role"] == "assistant" and key in pending:
+                message = pending.pop(key)
+                branch = classify_reply(r["content"])
+                was_in_flow = key in in_flow
+                if r["content"].startswith(("Il me manque", "RDV pour")):
+                    in_flow.add(key)
+                elif branch in ("confirmation", "confirmation_pending", "cancellation"):
+                    in_flow.discard(key)
+                # "❌ Annulé." = tout sauf "oui" à l'étape de confirmation : ce n'est pas une intention
+                if r["content"] == "❌ Annulé." or not (message or "").strip():
+                    continue
+                if was_in_flow and branch == "booking_attempt":
+                    continue
+                samples.append((r["client_id"], r["user_id"], message, BRANCH_TO_INTENT[branch]))
+        last_id = rows[-1]["id"]
+    return samples
+
+
+def _is_test(client_id: str, user_id: str) -> bool:
+    # Découpage par visiteur : les messages d'une même conversation restent du même côté
+    return zlib.crc32(f"{client_id}:{user_id}".encode("utf-8")) % 100 < TEST_FRACTION * 100
+
+
+def split_dataset(samples):
+    train = [(m, y) for c, u, m, y in samples if not _is_test(c, u)]
+    test = [(m, y) for c, u, m, y in samples if _is_test(c, u)]
+    return train, test
+
+
+# =========================================================
+# ENTRAÎNEMENT / ÉVALUATION
+# =========================================================
+
+def train(texts, labels, epochs: int = 50, lr: float = 5.0, l2: float = 1e-5, batch_size: int = 256, seed: int = 0) -> dict:
+    """Régression logistique multinomiale, descente de gradient par mini-lots."""
+    import numpy as np
+
+    classes = sorted(set(labels))
+    y = np.asarray([classes.index(label) for label in labels])
+    indptr, indices, values = _vectorize(texts)
+    n = len(texts)
+    W = np.zeros((N_FEATURES, len(classes)), dtype=np.float32)
+    b = np.zeros(len(classes), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+
+    for _ in range(epochs):
+        order = rng.permutation(n)
+        for start in range(0, n, batch_size):
+            batch = order[start:start + batch_size]
+            # Sous-matrice CSR du lot
+            lengths = indptr[batch + 1] - indptr[batch]
+            sel = np.concatenate([np.arange(indptr[i], indptr[i + 1]) for i in batch]) if lengths.sum() else np.zeros(0, dtype=np.int64)
+            X = (np.concatenate([[0], np.cumsum(lengths)]), indices[sel], values[sel])
+
+            grad = _softmax(_scores(W, b, X))
+            grad[np.arange(len(batch)), y[batch]] -= 1
+            grad /= len(batch)
+
+            rows = np.repeat(np.arange(len(batch)), lengths)
+            gW = np.zeros_like(W)
+            np.add.at(gW, X[1], X[2][:, None] * grad[rows])
+            W -= lr * (gW + l2 * W)
+            b -= lr * grad.sum(axis=0)
+
+    return {"W": W, "b": b, "classes": classes}
+
+
+def predict_proba_batch(model: dict, texts):
+    return _softmax(_scores(model["W"], model["b"], _vectorize(texts)))
+
+
+def evaluate(model: dict, test, threshold: float = INTENT_CONFIDENCE) -> dict:
+    """Exactitude, précision/rappel par intention, couverture au seuil, temps d'inférence unitaire."""
+    import numpy as np
+
+    if not test:
+        return {"samples": 0}
+    texts = [m for m, _ in test]
+    truth = [y for _, y in test]
+    proba = predict_proba_batch(model, texts)
+    pred = [model["classes"][i] for i in proba.argmax(axis=1)]
+    conf = proba.max(axis=1)
+    confident = conf >= threshold
+
+    per_class = {}
+    for cls in model["classes"]:
+        tp = sum(1 for p, t in zip(pred, truth) if p == cls and t == cls)
+        n_pred = sum(1 for p in pred if p == cls)
+        n_true = sum(1 for t in truth if t == cls)
+        per_class[cls] = {
+            "support": n_true,
+            "precision": round(tp / n_pred, 3) if n_pred else None,
+            "recall": round(tp / n_true, 3) if n_true else None,
+        }
+
+    # Inférence message par message, comme en production
+    timings = []
+    for text in texts[:1000]:
+        started = time.perf_counter()
+        _predict_one(model, text)
+        timings.append((time.perf_counter() - started) * 1e6)
+    timings.sort()
+
+    correct = np.asarray([p == t for p, t in zip(pred, truth)])
+    return {
+        "samples": len(test),
+        "accuracy": round(float(correct.mean()), 3),
+        "threshold": threshold,
+        "coverage": round(float(confident.mean()), 3),  # part des tours qui n'appelleraient plus le LLM
+        "accuracy_confident": round(float(correct[confident].mean()), 3) if confident.any() else None,
+        "per_class": per_class,
+        "inference_us": {
+            "mean": round(statistics.mean(timings), 1),
+            "p50": round(timings[len(timings) // 2], 1),
+            "p95": round(timings[int(len(timings) * 0.95)], 1),
+        },
+    }
+
+
+# =========================================================
+# CHARGEMENT / PRÉDICTION (production)
+# =========================================================
+
+def save(model: dict, meta: dict, path: str = INTENT_MODEL_PATH):
+    import json
+    import numpy as np
+
+    with open(path, "wb") as f:
+        np.savez_compressed(f, W=model["W"], b=model["b"], classes=np.asarray(model["classes"]), meta=json.dumps(meta))
+
+
+def load(path: str = INTENT_MODEL_PATH):
+    """Charge le modèle en mémoire (warmup). Sans fichier : tout passe par le LLM."""
+    global _model
+    if not os.path.exists(path):
+        print(f"⚠️ Pas de modèle d'intention ({path}) : tous les messages passent par le LLM")
+        return None
+    import json
+    import numpy as np
+
+    with np.load(path) as data:
+        model = {
+            "W": data["W"],
+            "b": data["b"],
+            "classes": [str(c) for c in data["classes"]],
+            "meta": json.loads(str(data["meta"])),
+        }
+    with _lock:
+        _model = model
+    return model["meta"]
+
+
+def status() -> dict:
+    model = _model
+    if model is None:
+        return {"loaded": False, "path": INTENT_MODEL_PATH}
+    return {"loaded": True, "path": INTENT_MODEL_PATH, "threshold": INTENT_CONFIDENCE, **model["meta"]}
+
+
+def _predict_one(model: dict, message: str):
+    import numpy as np
+
+    idx, val = featurize(message)
+    scores = model["b"].astype(np.float64)
+    if idx:
+        scores += np.asarray(val) @ model["W"][idx]
+    proba = _softmax(scores[None, :])[0]
+    best = int(proba.argmax())
+    return model["classes"][best], float(proba[best])
+
+
+def predict(message: str):
+    """(intention, confiance) ou None si aucun modèle n'est chargé."""
+    model = _model
+    if model is None:
+        return None
+    return _predict_one(model, message)
+
+
+# =========================================================
+# CLI
+# =========================================================
+
+def _print_report(report: dict):
+    print(f"🧪 Test : {report['samples']} messages, exactitude {report.get('accuracy')}")
+    if not report["samples"]:
+        return
+    print(f"   Seuil {report['threshold']} : couverture {report['coverage']}, exactitude {report['accuracy_confident']}")
+    for cls, m in report["per_class"].items():
+        print(f"   {cls:18} support {m['support']:6}  précision {m['precision']}  rappel {m['recall']}")
+    t = report["inference_us"]
+    print(f"⏱️ Inférence : moyenne {t['mean']} µs, p50 {t['p50']} µs, p95 {t['p95']} µs par message")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["train", "eval"])
+    parser.add_argument("--path", default=INTENT_MODEL_PATH)
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--threshold", type=float, default=INTENT_CONFIDENCE)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    samples = load_dataset()
+    train_set, test_set = split_dataset(samples)
+    print(f"📚 {len(samples)} messages étiquetés ({len(train_set)} entraînement, {len(test_set)} test)")
+
+    if args.command == "train":
+        if not train_set:
+            print("❌ Pas assez de données pour entraîner")
+            return
+        model = train([m for m, _ in train_set], [y for _, y in train_set], epochs=args.epochs)
+        report = evaluate(model, test_set, args.threshold)
+        meta = {
+            "trained_at": datetime.utcnow().isoformat(),
+            "train_samples": len(train_set),
+            "labels": dict(Counter(y for _, y in train_set)),
+            "test_accuracy": report.get("accuracy"),
+            "test_coverage": report.get("coverage"),
+        }
+        save(model, meta, args.path)
+        print(f"💾 Modèle sauvegardé : {args.path} ({round(time.perf_counter() - started, 1)} s)")
+    else:
+        if load(args.path) is None:
+            print(f"❌ Aucun modèle : {args.path}")
+            return
+        report = evaluate(_model, test_set, args.threshold)
+
+    _print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import importlib
+import os
+import socket
+import threading
+import time
+
+from db import warm_pool, close_pool, list_clients, list_google_clients, get_client_config, acquire_lease, release_leases
+from google_services import get_calendar_service
+
+try:
+    from config import SHUTDOWN_DRAIN_SECONDS, OPENAI_MODEL, WARMUP_BLOCKING
+except ImportError:
+    SHUTDOWN_DRAIN_SECONDS = 20.0
+    OPENAI_MODEL = "gpt-3.5-turbo"
+    WARMUP_BLOCKING = True
+
+# =========================================================
+# ÉTAT DU WORKER (readiness / drain)
+# =========================================================
+
+_state = {"ready": False, "draining": False, "warmup": None, "startup_ms": None}
+_inflight = 0
+_inflight_cond = threading.Condition()
+
+
+def is_ready() -> bool:
+    return _state["ready"] and not _state["draining"]
+
+
+def status() -> dict:
+    with _inflight_cond:
+        inflight = _inflight
+    return {
+        "ready": is_ready(),
+        "draining": _state["draining"],
+        "inflight": inflight,
+        "startup_ms": _state["startup_ms"],
+        "warmup": _state["warmup"],
+    }
+
+
+# Identité du worker pour les baux des tâches singleton
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def is_leader(job: str, interval_seconds: float) -> bool:
+    """
+    True si ce worker doit exécuter la tâche périodique `job` (un seul par base).
+    Le bail est renouvelé à chaque tour ; si le worker meurt, un autre le reprend
+    après 1,5 intervalle.
+    """
+    try:
+        return acquire_lease(job, WORKER_ID, interval_seconds * 1.5)
+    except Exception as e:
+        print(f"❌ Erreur bail {job} :", repr(e))
+        return False
+
+
+def mark_started(startup_ms: float):
+    """Durée imports + warmup du worker, visible dans /readyz et les logs."""
+    _state["startup_ms"] = round(startup_ms, 1)
+    print(f"⏱️ Worker prêt en {_state['startup_ms']} ms")
+
+
+def enter_request():
+    global _inflight
+    with _inflight_cond:
+        _inflight += 1
+
+
+def exit_request():
+    global _inflight
+    with _inflight_cond:
+        _inflight -= 1
+        _inflight_cond.notify_all()
+
+
+# =========================================================
+# WARMUP
+# =========================================================
+
+# Piles importées à la demande dans le code (démarrage à froid).
+# Avec PRELOAD_HEAVY_MODULES=1, le master gunicorn les importe avant le fork : les workers
+# les partagent en copy-on-write, au prix de ~1 s de plus avant d'accepter du trafic.
+HEAVY_MODULES = (
+    "google.oauth2.credentials",
+    "google.auth.transport.requests",
+    "google_auth_httplib2",
+    "google_auth_oauthlib.flow",
+    "googleapiclient.discovery",
+    "googleapiclient.errors",
+    "httplib2",
+    "openai",
+    "numpy",
+)
+
+
+def preload_heavy_modules() -> dict:
+    """Importe HEAVY_MODULES (master gunicorn). Retourne ms par module (ou l'erreur)."""
+    report = {}
+    for name in HEAVY_MODULES:
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+            report[name] = round((time.perf_counter() - started) * 1000, 1)
+        except ImportError as e:
+            report[name] = {"error": repr(e)}
+    print("📦 Modules préchargés (master) :", report)
+    return report
+
+
+def _timed(report: dict, key: str, fn):
+    started = time.perf_counter()
+    try:
+        report[key] = fn()
+    except Exception as e:
+        print(f"⚠️ Warmup {key} :", repr(e))
+        report[key] = {"error": repr(e)}
+    report[f"{key}_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def _prime_configs():
+    clients = list_clients()
+    for client_id in clients:
+        get_client_config(client_id)
+    return len(clients)
+
+
+def _prime_calendar():
+    """
+    Tokens Google rafraîchis (et sauvegardés) avant le premier tour, pile Google importée.
+    Le service construit ici n'est réutilisé que par ce thread (cache par thread).
+    """
+    primed = 0
+    for client_id in list_google_clients():
+        if get_calendar_service(client_id):
+            primed += 1
+    return primed
+
+
+def _prime_openai():
+    from bot_logic import get_openai_client, OPENAI_API_KEY
+    if not OPENAI_API_KEY:
+        return False
+    get_openai_client().models.retrieve(OPENAI_MODEL)
+    return True
+
+
+def _load_intent_model():
+    import intent_model
+    meta = intent_model.load()
+    return bool(meta)
+
+
+def _warm_heavy(report: dict):
+    _timed(report, "calendar_tokens", _prime_calendar)
+    _timed(report, "openai", _prime_openai)
+    _timed(report, "intent_model", _load_intent_model)
+
+
+def warmup(blocking: bool = WARMUP_BLOCKING) -> dict:
+    """
+    Prépare le worker avant d'accepter du trafic : pool DB rempli, configs clients
+    tokens Google rafraîchis et pile Google importée (les services Calendar sont mis en
+    cache par thread à leur premier usage, cf. get_calendar_service), connexion OpenAI ouverte,
+    classifieur d'intention local chargé en mémoire.
+    Avec blocking=False (démarrage à froid), la pile Google/OpenAI est chargée en
+    tâche de fond une fois le worker prêt.
+    Un échec de warmup est journalisé mais ne bloque pas le démarrage.
+    """
+    report = {}
+    _timed(report, "db_pool", warm_pool)
+    _timed(report, "client_configs", _prime_configs)
+    _state["warmup"] = report
+    if blocking:
+        _warm_heavy(report)
+    else:
+        threading.Thread(target=_warm_heavy, args=(report,), name="warmup", daemon=True).start()
+    _state["ready"] = True
+    print("🔥 Warmup :", report)
+    return report
+
+
+# =========================================================
+# ARRÊT PROPRE
+# =========================================================
+
+def drain(timeout: float = SHUTDOWN_DRAIN_SECONDS) -> bool:
+    """
+    Passe en drain (readyz -> 503), attend la fin des conversations en cours,
+    puis termine les écritures en tâche de fond et ferme le pool DB.
+    """
+    _state["draining"] = True
+    deadline = time.monotonic() + timeout
+    with _inflight_cond:
+        while _inflight > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _inflight_cond.wait(remaining)
+        drained = _inflight == 0
+
+    from bot_logic import TURN_EXECUTOR
+    import outbox
+    outbox.stop_dispatcher()
+    TURN_EXECUTOR.shutdown(wait=True)
+    # Rend les baux (slot_table...) : un autre worker reprend sans attendre l'expiration
+    try:
+        release_leases(WORKER_ID)
+    except Exception as e:
+        print("❌ Erreur libération des baux :", repr(e))
+    close_pool()
+    print("🛑 Worker arrêté proprement" if drained else "⚠️ Arrêt avec des conversations encore en cours")
+    return drained
@@ -1,22 +1,94 @@
+import time
+BOOT_STARTED = time.perf_counter()  # mesure du démarrage à froid (imports compris)
+
 import os
-from fastapi import FastAPI, Request, Depends, HTTPException, status
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
+import json
+import asyncio
+from fastapi import FastAPI, Request, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from google_auth_oauthlib.flow import Flow
-from config import GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REDIRECT_URI, ADMIN_PASSWORD, CLIENT_ID
-from db import save_google_credentials, init_db, save_message
-from bot_logic import handle_message
+from config import (
+    GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REDIRECT_URI, ADMIN_PASSWORD, CLIENT_ID,
+    MAINTENANCE_INTERVAL_HOURS, SLOT_TABLE_REFRESH_MINUTES, DUPLICATE_WINDOW_SECONDS, PROFILE_RING_SIZE,
+)
+from db import (
+    save_google_credentials, init_db, save_message, get_recent_messages, set_client_capacity, get_client_config,
+    list_profiles, get_profiles,
+)
+from capacity import CapacityConfig
+from bot_logic import handle_message, llm_breaker, BotReply
+from google_services import google_breaker, busy_flight, token_flight
+from maintenance import run_maintenance_exclusive
+import slot_table
+import lifecycle
+import outbox
+import analytics
+import intent_model
+import profiler
+from realtime import hub
+from session_queue import SessionSerializer
 print("✅ LOADED:", __file__)
 
 app = FastAPI()
 security = HTTPBasic()
+background_tasks = []
+sessions = SessionSerializer(BotReply, window=DUPLICATE_WINDOW_SECONDS)
+
+async def maintenance_loop():
+    """
+    Purge/archivage : vérifié au démarrage puis toutes les heures, exécuté si le dernier
+    passage (tous workers confondus) date de plus de MAINTENANCE_INTERVAL_HOURS heures.
+    """
+    interval = MAINTENANCE_INTERVAL_HOURS * 3600
+    while True:
+        try:
+            # Bail "maintenance" : un seul passage à la fois (sinon chaque lot serait archivé par tous)
+            report = await asyncio.to_thread(run_maintenance_exclusive, lifecycle.WORKER_ID, interval)
+            if report.get("skipped") == "running":
+                print("🧹 Maintenance déjà en cours sur un autre worker")
+        except Exception as e:
+            print("❌ Erreur maintenance :", repr(e))
+        await asyncio.sleep(min(interval, 3600))
+
+async def slot_table_loop():
+    """Recalcule les créneaux libres de chaque client toutes les SLOT_TABLE_REFRESH_MINUTES minutes."""
+    interval = SLOT_TABLE_REFRESH_MINUTES * 60
+    while True:
+        try:
+            # Un seul worker appelle Google ; les autres relisent la table en base
+            if await asyncio.to_thread(lifecycle.is_leader, "slot_table", interval):
+                report = await asyncio.to_thread(slot_table.refresh_all)
+                print("🗓️ Créneaux rafraîchis :", report)
+            else:
+                await asyncio.to_thread(slot_table.load_from_db)
+        except Exception as e:
+            print("❌ Erreur refresh créneaux :", repr(e))
+        await asyncio.sleep(interval)
 
 @app.on_event("startup")
-def startup_event():
-    init_db()
+async def startup_event():
+    # Le worker n'accepte pas de connexions tant que ce handler n'est pas terminé
+    if os.getenv("DB_SCHEMA_READY") != "1":
+        # Lancement direct (uvicorn) : sous gunicorn le schéma est créé par le master (on_starting)
+        await asyncio.to_thread(init_db)
+    await asyncio.to_thread(slot_table.load_from_db)
+    await asyncio.to_thread(lifecycle.warmup)
+    lifecycle.mark_started((time.perf_counter() - BOOT_STARTED) * 1000)
+    outbox.add_listener(push_booking_confirmed)
+    outbox.start_dispatcher()
+    if MAINTENANCE_INTERVAL_HOURS > 0:
+        background_tasks.append(asyncio.create_task(maintenance_loop()))
+    if SLOT_TABLE_REFRESH_MINUTES > 0:
+        background_tasks.append(asyncio.create_task(slot_table_loop()))
     print("✅ ROUTES:", [r.path for r in app.routes])
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.to_thread(lifecycle.drain)
+
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
 # --- FONCTION DE SÉCURITÉ ADMIN ---
@@ -30,6 +102,8 @@ def check_admin(credentials: HTTPBasicCredentials = Depends(security)):
     return credentials.username
 
 def get_flow():
+    # Import différé : google_auth_oauthlib n'est utile que pour la liaison admin
+    from google_auth_oauthlib.flow import Flow
     client_config = {"web": {"client_id": GOOGLE_CLIENT_ID, "client_secret": GOOGLE_CLIENT_SECRET,
                             "auth_uri": "https://accounts.google.com/o/oauth2/auth", "token_uri": "https://oauth2.googleapis.com/token"}}
     flow = Flow.from_client_config(client_config, scopes=['https://www.googleapis.com/auth/calendar.events'])
@@ -48,18 +122,198 @@ async def google_login(username: str = Depends(check_admin)):
     auth_url, _ = flow.authorization_url(prompt='consent', access_type='offline', state=CLIENT_ID)
     return RedirectResponse(auth_url)
 
+@app.post("/admin/maintenance")
+async def admin_maintenance(username: str = Depends(check_admin)):
+    report = await asyncio.to_thread(run_maintenance_exclusive, lifecycle.WORKER_ID)
+    if "skipped" in report:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Maintenance déjà en cours sur un autre worker")
+    return report
+
+@app.get("/admin/outbox")
+async def admin_outbox(username: str = Depends(check_admin)):
+    return await asyncio.to_thread(outbox.metrics)
+
+@app.get("/admin/stats")
+async def admin_stats(days: int = 30, client_id: str = CLIENT_ID, username: str = Depends(check_admin)):
+    return await asyncio.to_thread(analytics.dashboard, client_id, days)
+
+@app.get("/admin/singleflight")
+async def admin_singleflight(username: str = Depends(check_admin)):
+    return {"flights": [busy_flight.snapshot(), token_flight.snapshot()]}
+
+@app.get("/admin/sessions")
+async def admin_sessions(username: str = Depends(check_admin)):
+    return sessions.snapshot()
+
+@app.get("/admin/capacity")
+async def admin_get_capacity(client_id: str = CLIENT_ID, username: str = Depends(check_admin)):
+    cfg = await asyncio.to_thread(get_client_config, client_id)
+    return cfg["capacity"]
+
+@app.put("/admin/capacity")
+async def admin_set_capacity(config: CapacityConfig, client_id: str = CLIENT_ID, username: str = Depends(check_admin)):
+    # {"resources": 3, "default_duration": 60, "services": {"vidange": 30}, "calendars": [...], "booking_calendar": "..."}
+    capacity = config.model_dump()
+    await asyncio.to_thread(set_client_capacity, client_id, capacity)
+    # Les créneaux précalculés dépendent du nombre de ponts : recalcul
+    slot_table.invalidate(client_id)
+    asyncio.get_event_loop().run_in_executor(None, slot_table.refresh_client, client_id)
+    return capacity
+
+@app.get("/admin/intent_model")
+async def admin_intent_model(username: str = Depends(check_admin)):
+    return intent_model.status()
+
+@app.get("/admin/profiling")
+async def admin_profiling(username: str = Depends(check_admin)):
+    # Réglages et profils partagés par tous les workers (en base)
+    def read():
+        return {"settings": profiler.settings(), "profiles": list_profiles(PROFILE_RING_SIZE)}
+    return await asyncio.to_thread(read)
+
+@app.post("/admin/profiling")
+async def admin_profiling_configure(request: Request, username: str = Depends(check_admin)):
+    # {"sample_rate": 0.05, "request_ids": ["visitor-123"]} ; sample_rate 0 + request_ids [] = arrêt
+    data = await request.json()
+    try:
+        return await asyncio.to_thread(profiler.configure, data.get("sample_rate"), data.get("request_ids"))
+    except (TypeError, ValueError, AttributeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Réglages de profilage invalides")
+
+@app.get("/admin/profiling/folded")
+async def admin_profiling_folded(username: str = Depends(check_admin)):
+    # Tous les profils gardés, cumulés : flamegraph.pl profiles.folded > flame.svg (ou speedscope)
+    profiles = await asyncio.to_thread(get_profiles)
+    return PlainTextResponse(profiler.folded(profiles), headers={"Content-Disposition": 'attachment; filename="profiles.folded"'})
+
+@app.get("/admin/profiling/{profile_id}")
+async def admin_profiling_download(profile_id: int, format: str = "json", username: str = Depends(check_admin)):
+    profiles = await asyncio.to_thread(get_profiles, [profile_id])
+    if not profiles:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profil inconnu (sorti du buffer ?)")
+    profile = profiles[0]
+    if format == "folded":
+        return PlainTextResponse(profiler.folded([profile]), headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'})
+    if format == "trace":
+        # chrome://tracing ou ui.perfetto.dev
+        return JSONResponse(profiler.trace(profile), headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.trace.json"'})
+    return JSONResponse(profile, headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.json"'})
+
+@app.get("/admin/circuits")
+async def admin_circuits(username: str = Depends(check_admin)):
+    return {"circuits": [llm_breaker.snapshot(), google_breaker.snapshot()]}
+
 # Routes Publiques
+def process_chat(client_id: str, user_id: str, message: str, history: list):
+    """Tour complet (bloquant) : exécuté hors de la boucle asyncio."""
+    with profiler.request(client_id, user_id):
+        save_message(client_id, user_id, "user", message)
+        res = handle_message(client_id, user_id, message, history)
+        save_message(client_id, user_id, "assistant", res.reply)
+    return res
+
 @app.post("/chat")
 async def chat(request: Request):
     data = await request.json()
     client_id = request.query_params.get("clientID", CLIENT_ID)
     user_id = request.query_params.get("requestID", "visitor")
-    save_message(client_id, user_id, "user", data.get("message", ""))
-    res = handle_message(client_id, user_id, data.get("message", ""), data.get("history", []))
-    save_message(client_id, user_id, "assistant", res.reply)
+    message = data.get("message", "")
+    lifecycle.enter_request()
+    try:
+        res = await sessions.run(
+            client_id, user_id, message,
+            lambda: process_chat(client_id, user_id, message, data.get("history", [])),
+        )
+    finally:
+        lifecycle.exit_request()
 
     return {"reply": res.reply, "status": res.status}
 
+# --- TRANSPORT WEBSOCKET (widget) ---
+WS_HISTORY_MAX = 10
+
+def push_booking_confirmed(entry: dict, event: dict):
+    """Outbox : l'événement est dans Google -> on prévient le visiteur s'il est connecté."""
+    payload = entry["payload"]
+    if payload.get("user_id"):
+        hub.push(entry["client_id"], payload["user_id"], {
+            "type": "booking_confirmed",
+            "date": payload["date"],
+            "time": payload["time"],
+            "link": event.get("htmlLink"),
+        })
+
+@app.websocket("/ws")
+async def chat_ws(websocket: WebSocket):
+    """
+    Une connexion par chat ouvert : identité lue une fois, historique gardé côté serveur
+    (repris des derniers messages en base à la (re)connexion).
+    Client -> serveur : {"type": "message", "id": n, "message": "..."} | {"type": "ping"}
+    Serveur -> client : {"type": "typing"} | {"type": "reply", "id": n, "reply", "status"}
+                        | {"type": "booking_confirmed", ...} | {"type": "pong"}
+                        | {"type": "error", "id": n, "error": "..."} (trame invalide, la connexion reste ouverte)
+    """
+    client_id = websocket.query_params.get("clientID", CLIENT_ID)
+    user_id = websocket.query_params.get("requestID", "visitor")
+    await websocket.accept()
+    conn = hub.register(client_id, user_id, websocket)
+    try:
+        history = await asyncio.to_thread(get_recent_messages, client_id, user_id, WS_HISTORY_MAX)
+    except Exception as e:
+        print("❌ Erreur lecture historique WS :", repr(e))
+        history = []
+    try:
+        while True:
+            data = None
+            try:
+                # KeyError : trame binaire
+                data = json.loads(await websocket.receive_text())
+                if not isinstance(data, dict):
+                    raise ValueError("objet JSON attendu")
+                message = data.get("message", "")
+                if data.get("type") != "ping" and not isinstance(message, str):
+                    raise ValueError("message doit être une chaîne")
+            except (ValueError, KeyError) as e:
+                print("⚠️ Trame WS invalide :", repr(e))
+                msg_id = data.get("id") if isinstance(data, dict) else None
+                await hub.send(conn, {"type": "error", "id": msg_id, "error": "Trame invalide : objet JSON {\"type\", \"id\", \"message\"} attendu"})
+                continue
+
+            if data.get("type") == "ping":
+                await hub.send(conn, {"type": "pong"})
+                continue
+
+            await hub.send(conn, {"type": "typing"})
+            turn_history = list(history)
+            lifecycle.enter_request()
+            try:
+                res = await sessions.run(
+                    client_id, user_id, message,
+                    lambda: process_chat(client_id, user_id, message, turn_history),
+                )
+            finally:
+                lifecycle.exit_request()
+
+            history = (history + [
+                {"role": "user", "content": message},
+                {"role": "assistant", "content": res.reply},
+            ])[-WS_HISTORY_MAX:]
+            await hub.send(conn, {"type": "reply", "id": data.get("id"), "reply": res.reply, "status": res.status})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.unregister(client_id, user_id, conn)
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness : le processus répond
+    return {"ok": True}
+
+@app.get("/readyz")
+async def readyz():
+    # Readiness : warmup terminé et pas en cours d'arrêt
+    return JSONResponse(lifecycle.status(), status_code=200 if lifecycle.is_ready() else 503)
+
 @app.get("/oauth2callback")
 async def oauth2callback(request: Request):
     code = request.query_params.get("code")
@@ -80,6 +334,7 @@ async def oauth2callback(request: Request):
     }
 
     save_google_credentials(client_target, creds_dict)
+    asyncio.get_event_loop().run_in_executor(None, slot_table.refresh_client, client_target)
     return HTMLResponse(f"<h1>✅ Succès</h1><p>Agenda lié pour {client_target}</p>")
 from fastapi.responses import FileResponse
 
@@ -0,0 +1,192 @@
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from db import (
+    fetch_messages_before,
+    delete_messages_by_ids,
+    delete_sessions_before,
+    delete_outbox_done_before,
+    delete_daily_visitors_before,
+    acquire_lease,
+    release_lease,
+    get_app_setting,
+    set_app_setting,
+)
+
+try:
+    from config import (
+        MESSAGES_RETENTION_DAYS,
+        SESSIONS_TTL_HOURS,
+        ARCHIVE_DIR,
+        MAINTENANCE_BATCH_SIZE,
+    )
+except ImportError:
+    MESSAGES_RETENTION_DAYS = int(os.getenv("MESSAGES_RETENTION_DAYS", "90"))
+    SESSIONS_TTL_HOURS = int(os.getenv("SESSIONS_TTL_HOURS", "48"))
+    ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "")
+    MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "500"))
+
+
+# =========================================================
+# ARCHIVAGE DES MESSAGES
+# =========================================================
+
+def _archive_path(day: str) -> str:
+    """archives/messages/YYYY/MM/messages-YYYY-MM-DD.ndjson.gz"""
+    year, month, _ = day.split("-")
+    folder = os.path.join(ARCHIVE_DIR, "messages", year, month)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"messages-{day}.ndjson.gz")
+
+
+def _write_archive(rows) -> None:
+    """Ajoute les lignes aux fichiers gzip NDJSON du jour de création (un membre gzip par lot)."""
+    by_day = {}
+    for r in rows:
+        by_day.setdefault(str(r["created_at"])[:10], []).append(r)
+
+    for day, day_rows in by_day.items():
+        payload = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in day_rows)
+        with gzip.open(_archive_path(day), "ab") as f:
+            f.write(payload.encode("utf-8"))
+
+
+def archive_old_messages(retention_days: int = MESSAGES_RETENTION_DAYS, batch_size: int = MAINTENANCE_BATCH_SIZE) -> dict:
+    """
+    Archive puis supprime les messages plus vieux que retention_days, par lots bornés.
+    Le fichier est écrit AVANT la suppression : en cas de crash, au pire une ligne est archivée deux fois.
+    Sans ARCHIVE_DIR explicite (disque persistant), rien n'est archivé ni supprimé :
+    le disque local de Render est effacé à chaque déploiement.
+    """
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).isoformat()
+    if not ARCHIVE_DIR:
+        print("⚠️ ARCHIVE_DIR non configuré : messages conservés en base (pas d'archivage)")
+        return {"cutoff": cutoff, "skipped": "ARCHIVE_DIR non configuré", "archived": 0, "deleted": 0, "batches": 0}
+    archived = 0
+    deleted = 0
+    batches = 0
+
+    while True:
+        rows = fetch_messages_before(cutoff, limit=batch_size)
+        if not rows:
+            break
+        _write_archive(rows)
+        archived += len(rows)
+        deleted += delete_messages_by_ids([r["id"] for r in rows])
+        batches += 1
+        if len(rows) < batch_size:
+            break
+
+    return {"cutoff": cutoff, "archived": archived, "deleted": deleted, "batches": batches}
+
+
+# =========================================================
+# EXPIRATION DES SESSIONS
+# =========================================================
+
+def expire_stale_sessions(ttl_hours: int = SESSIONS_TTL_HOURS) -> dict:
+    """Supprime les sessions abandonnées (updated_at plus vieux que ttl_hours)."""
+    cutoff = (datetime.utcnow() - timedelta(hours=ttl_hours)).isoformat()
+    return {"cutoff": cutoff, "deleted": delete_sessions_before(cutoff)}
+
+
+def purge_sent_outbox(retention_days: int = MESSAGES_RETENTION_DAYS) -> dict:
+    """Supprime les entrées d'outbox envoyées depuis plus de retention_days (le RDV garde l'id Google)."""
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).isoformat()
+    return {"cutoff": cutoff, "deleted": delete_outbox_done_before(cutoff)}
+
+
+def purge_daily_visitors() -> dict:
+    """Seul le jour courant sert à compter les conversations : on garde une marge de 2 jours."""
+    cutoff = (datetime.utcnow() - timedelta(days=2)).date().isoformat()
+    return {"cutoff": cutoff, "deleted": delete_daily_visitors_before(cutoff)}
+
+
+# =========================================================
+# JOB COMPLET
+# =========================================================
+
+def run_maintenance() -> dict:
+    """Lance archivage + expiration et retourne un rapport (lignes récupérées, durée)."""
+    started = time.perf_counter()
+    report = {"started_at": datetime.utcnow().isoformat()}
+
+    try:
+        report["messages"] = archive_old_messages()
+    except Exception as e:
+        print("❌ Erreur archivage messages :", repr(e))
+        report["messages"] = {"error": repr(e)}
+
+    try:
+        report["sessions"] = expire_stale_sessions()
+    except Exception as e:
+        print("❌ Erreur expiration sessions :", repr(e))
+        report["sessions"] = {"error": repr(e)}
+
+    try:
+        report["outbox"] = purge_sent_outbox()
+    except Exception as e:
+        print("❌ Erreur purge outbox :", repr(e))
+        report["outbox"] = {"error": repr(e)}
+
+    try:
+        report["daily_visitors"] = purge_daily_visitors()
+    except Exception as e:
+        print("❌ Erreur purge visiteurs :", repr(e))
+        report["daily_visitors"] = {"error": repr(e)}
+
+    report["reclaimed_rows"] = sum(
+        report[k].get("deleted", 0) for k in ("messages", "sessions", "outbox", "daily_visitors")
+    )
+    report["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    print("🧹 Maintenance :", json.dumps(report))
+    return report
+
+
+# =========================================================
+# EXÉCUTION EXCLUSIVE (boucle + endpoint admin)
+# =========================================================
+
+MAINTENANCE_LEASE = "maintenance"
+MAINTENANCE_LEASE_SECONDS = 3600  # durée max d'un passage ; au-delà un autre worker peut reprendre
+LAST_RUN_KEY = "maintenance_last_run"
+
+
+def _last_run_age(now: datetime):
+    """Secondes écoulées depuis la dernière maintenance terminée (None si jamais)."""
+    last = get_app_setting(LAST_RUN_KEY)
+    return (now - datetime.fromisoformat(last)).total_seconds() if last else None
+
+
+def run_maintenance_exclusive(holder: str, min_interval_seconds: float = 0) -> dict:
+    """
+    Lance run_maintenance sous le bail "maintenance" : un seul passage à la fois
+    sur toute la base, que ce soit la boucle d'un worker ou l'endpoint admin.
+    Le bail n'est tenu que pendant le passage, puis rendu.
+    Saute si un autre passage est en cours ({"skipped": "running"}) ou si le dernier
+    date de moins de min_interval_seconds ({"skipped": "recent"}).
+    """
+    now = datetime.utcnow()
+    age = _last_run_age(now)
+    if min_interval_seconds and age is not None and age < min_interval_seconds:
+        return {"skipped": "recent", "last_run_age_s": round(age)}
+
+    if not acquire_lease(MAINTENANCE_LEASE, holder, MAINTENANCE_LEASE_SECONDS):
+        return {"skipped": "running"}
+    try:
+        # Relu sous le bail : un autre worker a pu finir entre-temps
+        age = _last_run_age(now)
+        if min_interval_seconds and age is not None and age < min_interval_seconds:
+            return {"skipped": "recent", "last_run_age_s": round(age)}
+        report = run_maintenance()
+        set_app_setting(LAST_RUN_KEY, datetime.utcnow().isoformat())
+        return report
+    finally:
+        release_lease(MAINTENANCE_LEASE, holder)
+
+
+if __name__ == "__main__":
+    run_maintenance()
@@ -0,0 +1,162 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+from db import claim_outbox, complete_outbox, retry_outbox, outbox_stats, get_failed_outbox
+from google_services import create_google_events_batch, busy_flight, BOT_EVENT_ID_PREFIX
+import slot_table
+
+try:
+    from config import OUTBOX_POLL_SECONDS, OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS
+except ImportError:
+    OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+    OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+
+# Bail d'une entrée réservée : si le worker meurt pendant l'envoi, elle redevient due après ce délai
+LEASE_SECONDS = 120
+BACKOFF_BASE_SECONDS = 10
+BACKOFF_MAX_SECONDS = 3600
+
+_wakeup = threading.Event()
+_stop = threading.Event()
+_thread = None
+_metrics = {"dispatched": 0, "retried": 0, "failed": 0, "postponed": 0, "batches": 0, "last_run_at": None}
+_metrics_lock = threading.Lock()
+_listeners = []
+
+
+def add_listener(fn):
+    """fn(entry, event) est appelé après chaque événement Google créé (ex : push WebSocket)."""
+    _listeners.append(fn)
+
+
+def event_id_for(appointment_id: int) -> str:
+    """Id d'événement Google déterministe (base32hex : a-v, 0-9) dérivé du RDV."""
+    return f"{BOT_EVENT_ID_PREFIX}{int(appointment_id):010d}"
+
+
+def _backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS))
+
+
+def _count(key: str, n: int = 1):
+    with _metrics_lock:
+        _metrics[key] += n
+
+
+def _fail(entry: dict, error: str):
+    attempts = entry["attempts"] + 1
+    failed = attempts >= OUTBOX_MAX_ATTEMPTS
+    next_at = (datetime.utcnow() + _backoff(attempts)).isoformat()
+    retry_outbox(entry["id"], attempts, next_at, error, failed=failed)
+    _count("failed" if failed else "retried")
+    if failed:
+        print(f"❌ Outbox {entry['id']} abandonnée après {attempts} essais : {error}")
+
+
+def _postpone(entry: dict):
+    """Appel jamais parti (circuit ouvert, Google non connecté) : replanifié sans consommer d'essai."""
+    next_at = (datetime.utcnow() + timedelta(seconds=BACKOFF_BASE_SECONDS)).isoformat()
+    retry_outbox(entry["id"], entry["attempts"], next_at, "Google indisponible (non envoyé)")
+    _count("postponed")
+
+
+# =========================================================
+# ENVOI
+# =========================================================
+
+def dispatch_once(batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    """Envoie les entrées dues à Google, groupées par client (un batch HTTP par client)."""
+    entries = claim_outbox(batch_size, LEASE_SECONDS)
+    if not entries:
+        return 0
+
+    by_client = {}
+    for entry in entries:
+        by_client.setdefault(entry["client_id"], []).append(entry)
+
+    for client_id, client_entries in by_client.items():
+        events = [dict(e["payload"], event_id=event_id_for(e["appointment_id"])) for e in client_entries]
+        results = create_google_events_batch(client_id, events)
+        _count("batches")
+
+        if results is None:
+            for entry in client_entries:
+                _postpone(entry)
+            continue
+
+        created = False
+        for entry, (event, error) in zip(client_entries, results):
+            if event is None:
+                _fail(entry, error or "erreur inconnue")
+                continue
+            complete_outbox(entry["id"], entry["appointment_id"], event.get("id"), event.get("htmlLink"))
+            _count("dispatched")
+            created = True
+            for listener in _listeners:
+                try:
+                    listener(entry, event)
+                except Exception as e:
+                    print("⚠️ Erreur listener outbox :", repr(e))
+
+        if created:
+            # Les disponibilités d'avant l'envoi ne voient pas ces RDV (ni dans Google, ni en attente) :
+            # on les oublie avant de recalculer
+            busy_flight.forget(client_id)
+            slot_table.invalidate(client_id)
+            slot_table.refresh_client(client_id)
+
+    with _metrics_lock:
+        _metrics["last_run_at"] = datetime.utcnow().isoformat()
+    return len(entries)
+
+
+def notify():
+    """Réveille le dispatcher (nouvelle entrée commitée)."""
+    _wakeup.set()
+
+
+def _run():
+    while not _stop.is_set():
+        _wakeup.wait(OUTBOX_POLL_SECONDS)
+        _wakeup.clear()
+        try:
+            while dispatch_once() and not _stop.is_set():
+                pass
+        except Exception as e:
+            print("❌ Erreur dispatcher outbox :", repr(e))
+
+
+def start_dispatcher():
+    global _thread
+    if _thread is None or not _thread.is_alive():
+        _stop.clear()
+        _thread = threading.Thread(target=_run, name="outbox", daemon=True)
+        _thread.start()
+
+
+def stop_dispatcher(timeout: float = 10.0):
+    """Arrêt propre : le lot en cours se termine (les entrées non envoyées restent en base)."""
+    _stop.set()
+    _wakeup.set()
+    if _thread is not None:
+        _thread.join(timeout)
+
+
+# =========================================================
+# MÉTRIQUES
+# =========================================================
+
+def metrics() -> dict:
+    """
+    Compteurs du worker + retard de l'outbox (âge de la plus ancienne entrée non envoyée)
+    + RDV abandonnés, à reporter à la main dans l'agenda (alerte de la page admin).
+    """
+    stats = outbox_stats()
+    lag = 0.0
+    if stats["oldest_pending"]:
+        lag = (datetime.utcnow() - datetime.fromisoformat(stats["oldest_pending"])).total_seconds()
+    with _metrics_lock:
+        counters = dict(_metrics)
+    return {"lag_seconds": round(lag, 1), "backlog": stats["counts"], "failed_entries": get_failed_outbox(), **counters}
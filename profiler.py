@@ -0,0 +1,265 @@
+"""
+Profilage à la demande des tours de conversation (/chat, /ws).
+
+Activé par l'admin pour une fraction des requêtes et/ou des requestID précis.
+Un tour profilé enregistre le temps réel (wall-clock) de chaque appel instrumenté :
+handle_message, fonctions de db.py et de google_services.py, appel OpenAI.
+Les réglages sont en base (relus toutes les SETTINGS_TTL_SECONDS secondes par
+chaque worker) et les PROFILE_RING_SIZE derniers profils, tous workers confondus,
+sont gardés en base. Exports : JSON, piles repliées (flamegraph.pl, speedscope)
+ou format Chrome trace (Perfetto).
+Hors profil, le coût d'un appel instrumenté est une lecture de contextvar.
+"""
+import contextvars
+import functools
+import inspect
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    from config import PROFILE_SAMPLE_RATE, PROFILE_RING_SIZE
+except ImportError:
+    PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+    PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "50"))
+
+ROOT = "turn"
+SETTINGS_KEY = "profiling"
+SETTINGS_TTL_SECONDS = 5.0
+DEFAULT_SETTINGS = {"sample_rate": PROFILE_SAMPLE_RATE, "request_ids": []}
+
+# Réglages lus en base, mis en cache quelques secondes par worker
+_settings_cache = {"value": DEFAULT_SETTINGS, "loaded_at": float("-inf")}
+
+# Profil du tour en cours et pile des appels instrumentés (propagés aux threads du pool)
+_current = contextvars.ContextVar("profile", default=None)
+_stack = contextvars.ContextVar("profile_stack", default=())
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor qui exécute chaque tâche dans le contexte (contextvars) de l'appelant."""
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+# =========================================================
+# PROFIL D'UN TOUR
+# =========================================================
+
+class Profile:
+    def __init__(self, client_id: str, user_id: str, reason: str):
+        self.client_id = client_id
+        self.user_id = user_id
+        self.reason = reason
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.duration_ms = None
+        # (pile, thread, début ms depuis le début du tour, durée ms)
+        self.spans = []
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, stack: tuple, start: float, end: float):
+        span = (stack, threading.current_thread().name, (start - self._t0) * 1000, (end - start) * 1000)
+        with self._lock:
+            # Tâches de fond qui se terminent après le tour : ignorées
+            if self.duration_ms is None:
+                self.spans.append(span)
+
+    def finish(self):
+        with self._lock:
+            self.duration_ms = (time.perf_counter() - self._t0) * 1000
+
+    def to_dict(self) -> dict:
+        spans = [
+            {"stack": list(stack), "thread": thread, "start_ms": round(start, 3), "duration_ms": round(duration, 3)}
+            for stack, thread, start, duration in sorted(self.spans, key=lambda s: s[2])
+        ]
+        return {
+            "client_id": self.client_id,
+            "user_id": self.user_id,
+            "worker": f"{os.getpid()}",
+            "reason": self.reason,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 3),
+            "calls": len(spans),
+            "breakdown_ms": breakdown(spans),
+            "spans": spans,
+        }
+
+
+# =========================================================
+# EXPORTS (à partir d'un profil sérialisé)
+# =========================================================
+
+def breakdown(spans) -> dict:
+    """
+    ms par catégorie (handle_message, db, google, openai...) : seul l'appel le plus
+    externe d'une catégorie compte. Les appels parallèles (pool) s'additionnent.
+    """
+    totals = defaultdict(float)
+    for span in spans:
+        categories = [name.split(".")[0] for name in span["stack"]]
+        if categories[-1] not in categories[:-1]:
+            totals[categories[-1]] += span["duration_ms"]
+    return {k: round(v, 1) for k, v in sorted(totals.items())}
+
+
+def _folded_one(profile: dict) -> dict:
+    """{pile repliée: µs de temps propre} (temps d'un appel moins celui de ses appels fils)."""
+    totals = defaultdict(float)
+    for span in profile["spans"]:
+        totals[(ROOT,) + tuple(span["stack"])] += span["duration_ms"] * 1000
+    totals[(ROOT,)] = profile["duration_ms"] * 1000
+
+    children = defaultdict(float)
+    for path, total in totals.items():
+        if len(path) > 1:
+            children[path[:-1]] += total
+    return {";".join(path): max(0.0, total - children[path]) for path, total in totals.items()}
+
+
+def folded(profiles) -> str:
+    """Piles repliées (une ligne "a;b;c µs"), cumulées sur plusieurs profils : entrée de flamegraph.pl."""
+    totals = defaultdict(float)
+    for profile in profiles:
+        for path, us in _folded_one(profile).items():
+            totals[path] += us
+    return "".join(f"{path} {round(us)}\n" for path, us in sorted(totals.items()) if round(us) > 0)
+
+
+def trace(profile: dict) -> dict:
+    """Format Chrome trace (chrome://tracing, ui.perfetto.dev) : un fil par thread."""
+    threads = {}
+    events = [{"name": ROOT, "cat": ROOT, "ph": "X", "ts": 0, "dur": round(profile["duration_ms"] * 1000), "pid": 1, "tid": 0}]
+    for span in profile["spans"]:
+        name = span["stack"][-1]
+        events.append({
+            "name": name,
+            "cat": name.split(".")[0],
+            "ph": "X",
+            "ts": round(span["start_ms"] * 1000),
+            "dur": round(span["duration_ms"] * 1000),
+            "pid": 1,
+            "tid": threads.setdefault(span["thread"], len(threads) + 1),
+        })
+    events.extend(
+        {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}}
+        for name, tid in threads.items()
+    )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+# =========================================================
+# INSTRUMENTATION
+# =========================================================
+
+def traced(name: str):
+    """Décorateur : chronomètre la fonction quand un tour est profilé."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profile = _current.get()
+            if profile is None:
+                return fn(*args, **kwargs)
+            stack = _stack.get() + (name,)
+            token = _stack.set(stack)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.add(stack, start, time.perf_counter())
+                _stack.reset(token)
+        return wrapper
+    return decorator
+
+
+def instrument(namespace: dict, category: str, include=()):
+    """
+    Instrumente les fonctions publiques d'un module (plus `include`).
+    À appeler en fin de module, avant que d'autres modules n'importent ses fonctions.
+    """
+    module = namespace["__name__"]
+    for name, obj in list(namespace.items()):
+        if inspect.isfunction(obj) and obj.__module__ == module and (not name.startswith("_") or name in include):
+            namespace[name] = traced(f"{category}.{name}")(obj)
+
+
+# =========================================================
+# RÉGLAGES / ÉCHANTILLONNAGE
+# =========================================================
+
+def settings() -> dict:
+    """Réglages partagés (table app_settings), relus au plus toutes les SETTINGS_TTL_SECONDS."""
+    now = time.monotonic()
+    if now - _settings_cache["loaded_at"] > SETTINGS_TTL_SECONDS:
+        _settings_cache["loaded_at"] = now
+        try:
+            # Import différé : db importe ce module pour s'instrumenter
+            from db import get_app_setting
+            _settings_cache["value"] = {**DEFAULT_SETTINGS, **(get_app_setting(SETTINGS_KEY) or {})}
+        except Exception as e:
+            print("❌ Erreur lecture réglages profilage :", repr(e))
+    return _settings_cache["value"]
+
+
+def configure(sample_rate: float = None, request_ids=None) -> dict:
+    """Change les réglages pour tous les workers (pris en compte en moins de SETTINGS_TTL_SECONDS)."""
+    from db import set_app_setting
+
+    _settings_cache["loaded_at"] = float("-inf")
+    new = dict(settings())
+    if sample_rate is not None:
+        new["sample_rate"] = min(1.0, max(0.0, float(sample_rate)))
+    if request_ids is not None:
+        if isinstance(request_ids, str):
+            raise ValueError("request_ids doit être une liste")
+        new["request_ids"] = sorted({str(r) for r in request_ids})
+    set_app_setting(SETTINGS_KEY, new)
+    _settings_cache.update(value=new, loaded_at=time.monotonic())
+    return {**new, "ring_size": PROFILE_RING_SIZE}
+
+
+def _reason(user_id: str):
+    current = settings()
+    if user_id in current["request_ids"]:
+        return "request_id"
+    rate = current["sample_rate"]
+    if rate > 0 and random.random() < rate:
+        return "sampled"
+    return None
+
+
+@contextmanager
+def request(client_id: str, user_id: str):
+    """Profile le bloc si la requête est échantillonnée (sinon ne fait rien)."""
+    reason = _reason(user_id)
+    if reason is None:
+        yield None
+        return
+
+    profile = Profile(client_id, user_id, reason)
+    token = _current.set(profile)
+    stack_token = _stack.set(())
+    try:
+        yield profile
+    finally:
+        _stack.reset(stack_token)
+        _current.reset(token)
+        profile.finish()
+        _store(profile)
+
+
+def _store(profile: Profile):
+    data = profile.to_dict()
+    try:
+        from db import save_profile
+        profile_id = save_profile(data, PROFILE_RING_SIZE)
+        print(f"🔬 Profil #{profile_id} ({profile.user_id}) : {profile.duration_ms:.0f} ms {data['breakdown_ms']}")
+    except Exception as e:
+        print("❌ Erreur sauvegarde profil :", repr(e))
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+# =========================================================
+# CONNEXIONS WEBSOCKET (push serveur -> widget)
+# =========================================================
+
+
+class ConnectionHub:
+    """
+    Connexions WebSocket ouvertes, par (client_id, user_id).
+    push() peut être appelé depuis n'importe quel thread (dispatcher outbox, pool de tours) :
+    l'envoi est replanifié sur la boucle asyncio de la connexion.
+    Chaque worker a son propre hub : un push ne joint que les visiteurs connectés à ce worker.
+    """
+
+    def __init__(self):
+        self._conns = {}
+        self._lock = threading.Lock()
+
+    def register(self, client_id: str, user_id: str, websocket):
+        conn = {"ws": websocket, "loop": asyncio.get_running_loop(), "send_lock": asyncio.Lock()}
+        with self._lock:
+            self._conns.setdefault((client_id, user_id), []).append(conn)
+        return conn
+
+    def unregister(self, client_id: str, user_id: str, conn):
+        with self._lock:
+            conns = self._conns.get((client_id, user_id), [])
+            if conn in conns:
+                conns.remove(conn)
+            if not conns:
+                self._conns.pop((client_id, user_id), None)
+
+    async def send(self, conn, payload: dict):
+        """Envoi sérialisé (réponses et pushes ne s'entrelacent pas sur une connexion)."""
+        async with conn["send_lock"]:
+            await conn["ws"].send_json(payload)
+
+    def push(self, client_id: str, user_id: str, payload: dict) -> int:
+        """Envoie payload à toutes les connexions du visiteur. Retourne le nombre de connexions visées."""
+        with self._lock:
+            conns = list(self._conns.get((client_id, user_id), []))
+        for conn in conns:
+            try:
+                asyncio.run_coroutine_threadsafe(self.send(conn, payload), conn["loop"])
+            except RuntimeError:
+                pass  # boucle fermée (arrêt du worker)
+        return len(conns)
+
+    def count(self) -> int:
+        with self._lock:
+            return sum(len(c) for c in self._conns.values())
+
+
+hub = ConnectionHub()
@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import deque
+
+# =========================================================
+# CIRCUIT BREAKER (OpenAI / Google Calendar)
+# =========================================================
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Disjoncteur à taux d'échec sur fenêtre glissante.
+
+    - closed    : les appels passent, on mémorise les `window` derniers résultats.
+                  Si au moins `min_calls` résultats et taux d'échec >= `failure_rate` -> open.
+    - open      : échec immédiat pendant `open_seconds`.
+    - half_open : une seule sonde à la fois ; succès -> closed, échec -> open.
+                  Une sonde sans réponse après `open_seconds` libère sa place.
+    """
+
+    def __init__(self, name: str, failure_rate: float = 0.5, min_calls: int = 4, window: int = 20, open_seconds: float = 30.0):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self._results = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_started_at = None
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    # --- état ---
+
+    def _refresh_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probe_started_at = None
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh_state()
+            return self._state
+
+    def is_closed(self) -> bool:
+        """True si les appels passent normalement (sans consommer de sonde)."""
+        return self.state == CLOSED
+
+    def allow(self) -> bool:
+        """True si l'appel peut partir. En half_open, réserve la sonde."""
+        with self._lock:
+            self._refresh_state()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN:
+                now = time.monotonic()
+                if self._probe_started_at is None or now - self._probe_started_at >= self.open_seconds:
+                    self._probe_started_at = now
+                    return True
+            self._rejected += 1
+            return False
+
+    def _trip(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._probe_started_at = None
+        print(f"⚡ Circuit {self.name} OUVERT")
+
+    def record_success(self):
+        with self._lock:
+            self._results.append(True)
+            if self._state == HALF_OPEN:
+                self._state = CLOSED
+                self._results.clear()
+                self._probe_started_at = None
+                print(f"✅ Circuit {self.name} refermé")
+
+    def record_failure(self):
+        with self._lock:
+            self._results.append(False)
+            if self._state == HALF_OPEN:
+                self._trip()
+                return
+            if self._state == CLOSED and len(self._results) >= self.min_calls:
+                failures = sum(1 for ok in self._results if not ok)
+                if failures / len(self._results) >= self.failure_rate:
+                    self._trip()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._refresh_state()
+            total = len(self._results)
+            failures = sum(1 for ok in self._results if not ok)
+            return {
+                "name": self.name,
+                "state": self._state,
+                "window_calls": total,
+                "window_failures": failures,
+                "rejected": self._rejected,
+            }
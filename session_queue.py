@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import json
+import time
+from dataclasses import asdict
+from datetime import datetime
+
+from db import session_turn_lock, get_last_turn, save_last_turn
+
+# =========================================================
+# SÉRIALISATION PAR VISITEUR + ANTI-DOUBLE ENVOI
+# =========================================================
+
+
+class SessionSerializer:
+    """
+    - Les tours d'un même visiteur (client_id, user_id) s'exécutent l'un après l'autre,
+      dans l'ordre d'arrivée (asyncio.Lock est FIFO) : plus de sessions qui s'écrasent.
+    - Un message identique à un message en cours (ou traité il y a moins de `window` secondes)
+      reçoit le même résultat sans être recalculé (touche Entrée pressée plusieurs fois).
+    Dans un worker, l'attente se fait dans la boucle asyncio (aucun thread occupé).
+    Entre workers, le tour s'exécute sous un verrou DB par visiteur, et le dernier
+    message traité (hash + réponse) est gardé sur la ligne de session : un doublon
+    arrivé sur un autre worker reçoit la réponse déjà calculée.
+    `result_type` : dataclass du résultat (recréée depuis la réponse stockée).
+    """
+
+    def __init__(self, result_type, window: float = 5.0):
+        self.result_type = result_type
+        self.window = window
+        self._locks = {}
+        self._inflight = {}
+        self._recent = {}
+        self._stats = {"turns": 0, "queued": 0, "duplicates_inflight": 0, "duplicates_recent": 0, "duplicates_db": 0}
+
+    @staticmethod
+    def _normalize(message: str) -> str:
+        return " ".join((message or "").lower().split())
+
+    def _run_locked(self, client_id: str, user_id: str, message: str, fn):
+        """(résultat, doublon?) : exécuté dans un thread, sous le verrou DB du visiteur."""
+        message_hash = hashlib.sha256(self._normalize(message).encode("utf-8")).hexdigest()
+        with session_turn_lock(client_id, user_id):
+            last = get_last_turn(client_id, user_id)
+            if (
+                last
+                and last["message_hash"] == message_hash
+                and (datetime.utcnow() - datetime.fromisoformat(last["at"])).total_seconds() < self.window
+            ):
+                return self.result_type(**json.loads(last["reply_json"])), True
+            result = fn()
+            save_last_turn(client_id, user_id, message_hash, json.dumps(asdict(result)))
+            return result, False
+
+    def _prune(self, now: float):
+        for k in [k for k, (expires, _) in self._recent.items() if expires <= now]:
+            del self._recent[k]
+
+    async def run(self, client_id: str, user_id: str, message: str, fn):
+        """Exécute fn() (bloquant, dans un thread) pour ce tour, en respectant l'ordre et l'anti-doublon."""
+        session_key = (client_id, user_id)
+        dedup_key = (client_id, user_id, self._normalize(message))
+        now = time.monotonic()
+
+        self._prune(now)
+        recent = self._recent.get(dedup_key)
+        if recent:
+            self._stats["duplicates_recent"] += 1
+            return recent[1]
+
+        inflight = self._inflight.get(dedup_key)
+        if inflight is not None:
+            self._stats["duplicates_inflight"] += 1
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[dedup_key] = future
+
+        entry = self._locks.setdefault(session_key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        if entry[0].locked():
+            self._stats["queued"] += 1
+        try:
+            async with entry[0]:
+                result, duplicate = await asyncio.to_thread(self._run_locked, client_id, user_id, message, fn)
+            self._stats["duplicates_db" if duplicate else "turns"] += 1
+            future.set_result(result)
+            self._recent[dedup_key] = (time.monotonic() + self.window, result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # marque l'exception comme lue s'il n'y a pas d'autre appelant
+            raise
+        finally:
+            del self._inflight[dedup_key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[session_key]
+
+    def snapshot(self) -> dict:
+        return {"active_sessions": len(self._locks), "in_flight": len(self._inflight), **self._stats}
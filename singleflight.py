@@ -0,0 +1,80 @@
+import threading
+import time
+
+# =========================================================
+# SINGLE-FLIGHT : un seul appel amont pour des requêtes identiques simultanées
+# =========================================================
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Les appels concurrents avec la même clé partagent UNE exécution de fn et son résultat.
+    Le résultat peut en plus être gardé `ttl` secondes (très court) pour les appels qui arrivent juste après.
+    Les exceptions sont propagées à tous les appelants en attente mais jamais mises en cache.
+    """
+
+    def __init__(self, name: str, ttl: float = 0.0):
+        self.name = name
+        self.ttl = ttl
+        self._calls = {}
+        self._results = {}
+        self._lock = threading.Lock()
+        self._stats = {"executed": 0, "coalesced": 0, "cache_hits": 0}
+
+    def do(self, key, fn, cache_if=None):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._results.get(key)
+            if cached and cached[0] > now:
+                self._stats["cache_hits"] += 1
+                return cached[1]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self._stats["executed"] += 1
+            else:
+                self._stats["coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None and self.ttl > 0 and (cache_if is None or cache_if(call.result)):
+                    self._prune(now)
+                    self._results[key] = (time.monotonic() + self.ttl, call.result)
+            call.done.set()
+        return call.result
+
+    def _prune(self, now: float):
+        if len(self._results) > 1000:
+            for k in [k for k, (expires, _) in self._results.items() if expires <= now]:
+                del self._results[k]
+
+    def forget(self, client_id):
+        """Oublie les résultats en cache d'un client (clés dont le 1er élément est client_id)."""
+        with self._lock:
+            for k in [k for k in self._results if k[0] == client_id]:
+                del self._results[k]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"name": self.name, "in_flight": len(self._calls), **self._stats}
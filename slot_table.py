@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from db import get_client_config, list_google_clients, upsert_slot_days, get_slot_days, get_appointments_between
+from google_services import get_busy_intervals_range
+from capacity import DEFAULT_CAPACITY, build_day_tree, has_capacity, appointment_intervals
+
+try:
+    from config import SLOT_TABLE_DAYS, SLOT_TABLE_REFRESH_MINUTES
+except ImportError:
+    SLOT_TABLE_DAYS = int(os.getenv("SLOT_TABLE_DAYS", "14"))
+    SLOT_TABLE_REFRESH_MINUTES = float(os.getenv("SLOT_TABLE_REFRESH_MINUTES", "10"))
+
+TZ = ZoneInfo("Europe/Paris")
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+# Au-delà de 2 rafraîchissements manqués, la table n'est plus utilisée
+MAX_AGE_SECONDS = SLOT_TABLE_REFRESH_MINUTES * 60 * 2
+
+# (client_id, date) -> {"busy": [(début, fin)], "free": ["HH:MM"], "refreshed_at": epoch}
+# busy : événements Google seuls ; free : tient compte aussi des RDV locaux au moment du calcul
+_table = {}
+# client_id -> epoch de la dernière invalidation (les lectures Google antérieures sont ignorées)
+_invalidated = {}
+_lock = threading.Lock()
+
+
+# =========================================================
+# CALCUL DES CRÉNEAUX
+# =========================================================
+
+def compute_free_slots(opening_hours: dict, date_str: str, busy, capacity: dict = DEFAULT_CAPACITY, step_minutes: int = 60):
+    """Créneaux libres du jour : dans les horaires d'ouverture, non passés, avec au moins un pont libre."""
+    day = datetime.strptime(date_str, "%Y-%m-%d")
+    slot = opening_hours.get(DAYS[day.weekday()])
+    if not slot:
+        return []
+
+    start = datetime.strptime(f"{date_str} {slot['start']}", "%Y-%m-%d %H:%M").replace(tzinfo=TZ)
+    end = datetime.strptime(f"{date_str} {slot['end']}", "%Y-%m-%d %H:%M").replace(tzinfo=TZ)
+    now = datetime.now(TZ)
+    duration_mins = int(capacity["default_duration"])
+    tree = build_day_tree(busy, date_str)
+
+    free = []
+    cand = start
+    while cand + timedelta(minutes=duration_mins) <= end:
+        t = cand.strftime("%H:%M")
+        if cand >= now and has_capacity(tree, t, duration_mins, capacity["resources"]):
+            free.append(t)
+        cand += timedelta(minutes=step_minutes)
+    return free
+
+
+def _encode_busy(busy) -> str:
+    return json.dumps([[s.isoformat(), e.isoformat()] for s, e in busy])
+
+
+def _decode_busy(busy_json: str):
+    return [(datetime.fromisoformat(s), datetime.fromisoformat(e)) for s, e in json.loads(busy_json)]
+
+
+# =========================================================
+# RAFRAÎCHISSEMENT
+# =========================================================
+
+def refresh_client(client_id: str) -> bool:
+    """
+    Recalcule les SLOT_TABLE_DAYS prochains jours du client (1 appel Google).
+    Un refresh plus ancien qui finit après un plus récent n'écrase pas ce dernier.
+    """
+    started = time.time()
+    cfg = get_client_config(client_id)
+    first_day = datetime.now(TZ).date().isoformat()
+    capacity = cfg["capacity"]
+    busy_by_day = get_busy_intervals_range(client_id, first_day, days=SLOT_TABLE_DAYS, calendar_ids=capacity["calendars"])
+    if busy_by_day is None:
+        return False
+
+    # RDV déjà dans Google : comptés via busy_by_day
+    appointments = get_appointments_between(client_id, first_day, max(busy_by_day), pending_only=True)
+    rows = []
+    with _lock:
+        if started < _invalidated.get(client_id, 0):
+            return False
+        for key in [k for k in _table if k[0] == client_id and k[1] < first_day]:
+            del _table[key]
+        for date_str, busy in busy_by_day.items():
+            current = _table.get((client_id, date_str))
+            if current and current["refreshed_at"] > started:
+                continue
+            local = appointment_intervals(appointments.get(date_str, []), date_str, capacity["default_duration"])
+            free = compute_free_slots(cfg["opening_hours"], date_str, busy + local, capacity)
+            _table[(client_id, date_str)] = {"busy": busy, "free": free, "refreshed_at": started}
+            rows.append((date_str, _encode_busy(busy), json.dumps(free)))
+
+    try:
+        refreshed_at = datetime.fromtimestamp(started, timezone.utc).replace(tzinfo=None).isoformat(timespec="microseconds")
+        upsert_slot_days(client_id, rows, refreshed_at)
+    except Exception as e:
+        print("❌ Erreur sauvegarde slot_table :", repr(e))
+    return True
+
+
+def refresh_all() -> dict:
+    """Rafraîchit tous les clients ayant un agenda Google."""
+    started = time.perf_counter()
+    refreshed, failed = 0, 0
+    for client_id in list_google_clients():
+        try:
+            ok = refresh_client(client_id)
+        except Exception as e:
+            print(f"❌ Erreur refresh créneaux {client_id} :", repr(e))
+            ok = False
+        refreshed += ok
+        failed += not ok
+    return {"refreshed": refreshed, "failed": failed, "duration_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+
+def invalidate(client_id: str, date_str: str = None):
+    """Oublie un jour (ou tout le client) : les lectures repassent par Google jusqu'au refresh."""
+    with _lock:
+        _invalidated[client_id] = time.time()
+        for key in [k for k in _table if k[0] == client_id and (date_str is None or k[1] == date_str)]:
+            del _table[key]
+
+
+def load_from_db():
+    """Recharge le cache mémoire depuis slot_table (démarrage, workers non leaders)."""
+    loaded = 0
+    rows = get_slot_days()
+    with _lock:
+        for row in rows:
+            refreshed_at = datetime.fromisoformat(row["refreshed_at"]).replace(tzinfo=timezone.utc).timestamp()
+            current = _table.get((row["client_id"], row["date"]))
+            if (current and current["refreshed_at"] >= refreshed_at) or refreshed_at < _invalidated.get(row["client_id"], 0):
+                continue
+            _table[(row["client_id"], row["date"])] = {
+                "busy": _decode_busy(row["busy_json"]),
+                "free": json.loads(row["free_json"]),
+                "refreshed_at": refreshed_at,
+            }
+            loaded += 1
+    return loaded
+
+
+# =========================================================
+# LECTURE
+# =========================================================
+
+def _fresh_entry(client_id: str, date_str: str):
+    with _lock:
+        entry = _table.get((client_id, date_str))
+    if entry and time.time() - entry["refreshed_at"] <= MAX_AGE_SECONDS:
+        return entry
+    return None
+
+
+def get_busy(client_id: str, date_str: str):
+    """Intervalles occupés précalculés, ou None si absents/périmés."""
+    entry = _fresh_entry(client_id, date_str)
+    return entry["busy"] if entry else None
+
+
+def get_free_slots(client_id: str, date_str: str):
+    """Créneaux libres précalculés, ou None si absents/périmés."""
+    entry = _fresh_entry(client_id, date_str)
+    return list(entry["free"]) if entry else None
@@ -1,6 +1,7 @@
 (function() {
    // --- CONFIGURATION ---
    const API_URL = "https://bot-rdv.onrender.com/chat";
+   const WS_URL = API_URL.replace(/^http/, "ws").replace(/\/chat$/, "/ws");
   
    // On récupère ou on crée un ID utilisateur unique
    let userId = localStorage.getItem("bot_user_id");
@@ -115,6 +116,71 @@
    }
 
 
+   // --- 3. TRANSPORT WEBSOCKET (repli sur le POST /chat) ---
+   // Une connexion par chat ouvert : pas de preflight CORS ni de ré-identification à chaque message.
+   let socket = null;
+   let socketReady = false;
+   let nextId = 1;
+   const pending = {};
+   let typingDiv = null;
+
+
+   function showTyping() {
+       if (typingDiv) return;
+       typingDiv = document.createElement('div');
+       typingDiv.innerText = "…";
+       Object.assign(typingDiv.style, { alignSelf: 'flex-start', color: '#888', fontSize: '14px', padding: '0 10px' });
+       messagesArea.appendChild(typingDiv);
+       messagesArea.scrollTop = messagesArea.scrollHeight;
+   }
+
+
+   function hideTyping() {
+       if (typingDiv) typingDiv.remove();
+       typingDiv = null;
+   }
+
+
+   function connectSocket() {
+       if (socket || !("WebSocket" in window)) return;
+       socket = new WebSocket(`${WS_URL}?clientID=${clientId}&requestID=${userId}`);
+       socket.onopen = () => { socketReady = true; };
+       socket.onmessage = (event) => {
+           const data = JSON.parse(event.data);
+           if (data.type === "typing") {
+               showTyping();
+           } else if (data.type === "reply" || data.type === "error") {
+               hideTyping();
+               const resolve = pending[data.id];
+               delete pending[data.id];
+               if (resolve) resolve(data);
+           } else if (data.type === "booking_confirmed") {
+               addMessage(`📅 Votre RDV du ${data.date} à ${data.time} est bien inscrit dans l'agenda du garage.`, "bot");
+           }
+       };
+       socket.onclose = () => {
+           socket = null;
+           socketReady = false;
+           hideTyping();
+           // Message parti sans réponse : on ne le renvoie pas (il a pu être traité)
+           Object.keys(pending).forEach((id) => { pending[id](null); delete pending[id]; });
+       };
+   }
+
+
+   function sendViaSocket(text) {
+       return new Promise((resolve) => {
+           const id = nextId++;
+           pending[id] = resolve;
+           socket.send(JSON.stringify({ type: "message", id: id, message: text }));
+       });
+   }
+
+
+   // Garde la connexion ouverte derrière les proxys (timeout d'inactivité)
+   setInterval(() => { if (socketReady) socket.send(JSON.stringify({ type: "ping" })); }, 25000);
+
+
    async function sendMessage() {
     const text = inputField.value.trim();
     if (!text) return;
@@ -122,6 +188,23 @@
     addMessage(text, 'user');
     inputField.value = "";
 
+    if (socketReady) {
+        const data = await sendViaSocket(text);
+        if (!data) {
+            addMessage("❌ Problème réseau (connexion).", "bot");
+            return;
+        }
+        if (data.type === "error") {
+            addMessage("❌ Le serveur a eu un souci. Réessaie.", "bot");
+            return;
+        }
+        addMessage(data.reply, "bot");
+        chatHistory.push({ role: "user", content: text });
+        chatHistory.push({ role: "assistant", content: data.reply });
+        return;
+    }
+    connectSocket();  // pour les messages suivants
+
     const targetUrl = `${API_URL}?clientID=${clientId}&requestID=${userId}`;
 
     try {
@@ -157,6 +240,7 @@
    bubble.onclick = () => {
        const isClosed = chatBox.style.display === 'none';
        chatBox.style.display = isClosed ? 'flex' : 'none';
+       if (isClosed) connectSocket();
        bubble.innerText = isClosed ? "" : "";
    };
 